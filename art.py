@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of xbmcpd.
+
+# xbmcpd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# xbmcpd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with xbmcpd.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import hashlib
+import logging
+import os
+import threading
+
+
+def image_type(data):
+    """
+    Guess MIME type of an image from its first bytes, or return None.
+    """
+    if data.startswith('\xff\xd8'):
+        return 'image/jpeg'
+    elif data.startswith('\x89PNG'):
+        return 'image/png'
+    elif data.startswith('GIF8'):
+        return 'image/gif'
+    return None
+
+
+class ArtCache(object):
+    """
+    Image bytes in a least recently used cache bounded by memory use,
+    optionally backed by a directory bounded by disk use.
+    Images that don't exist are remembered as empty strings.
+    """
+
+    def __init__(self, memory_budget, directory=None, disk_budget=0):
+        self._budget = memory_budget
+        self._used = 0
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self._directory = directory
+        self._disk_budget = disk_budget
+        self._disk_lock = threading.Lock()
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key, load):
+        """
+        Return image bytes for the key, calling load() to get them if they
+        are not cached. Returns an empty string if there is no image.
+        """
+        with self._lock:
+            data = self._images.pop(key, None)
+            if data is not None:
+                self._images[key] = data
+                return data
+
+        data = self._read_file(key)
+        if data is None:
+            data = load() or ''
+            if data:
+                self._write_file(key, data)
+
+        self._put(key, data)
+        return data
+
+    def _put(self, key, data):
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self._used -= len(old)
+
+            self._images[key] = data
+            self._used += len(data)
+
+            while self._used > self._budget and self._images:
+                evicted_key, evicted = self._images.popitem(last=False)
+                self._used -= len(evicted)
+
+    def _filename(self, key):
+        return os.path.join(self._directory,
+            hashlib.sha1(key.encode('utf8')).hexdigest())
+
+    def _read_file(self, key):
+        if self._directory is None:
+            return None
+
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+
+        return data
+
+    def _write_file(self, key, data):
+        """
+        Store the image in the directory and remove the least recently used
+        files while the directory is over its budget.
+        """
+        if self._directory is None:
+            return
+
+        filename = self._filename(key)
+        try:
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(data)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError) as e:
+            logging.warning(u'writing image to cache failed: {}'.format(e))
+            return
+
+        with self._disk_lock:
+            files = []
+            total = 0
+            for name in os.listdir(self._directory):
+                path = os.path.join(self._directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+            files.sort()
+            for mtime, size, path in files:
+                if total <= self._disk_budget:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
@@ -0,0 +1,853 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of xbmcpd.
+
+# xbmcpd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# xbmcpd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with xbmcpd.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import collections
+import itertools
+import operator
+import sys
+import threading
+
+# Directory or playlist inside the music directory.
+# file is the XBMC path, path is the MPD path.
+Entry = collections.namedtuple('Entry', ['file', 'path'])
+
+
+# Names of the song tags in the MPD protocol.
+MPD_TAGS = {
+    'artist': 'Artist',
+    'album': 'Album',
+    'title': 'Title',
+    'track': 'Track',
+    'genre': 'Genre',
+    'year': 'Date',
+    'duration': 'Time'}
+
+
+class Interner(object):
+    """
+    Maps equal values to a single shared instance.
+    Used to avoid keeping thousands of copies of the same artist name.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def __call__(self, value):
+        return self._values.setdefault(value, value)
+
+
+class Song(object):
+    """
+    Compact record of a single song.
+    Keeps the XBMC path, the precomputed MPD path and the tags.
+    """
+
+    # XBMC tags stored in the record (everything except the paths).
+    TAGS = ('title', 'artist', 'album', 'track', 'genre', 'year', 'duration')
+
+    __slots__ = ('file', 'path') + TAGS
+
+    def __init__(self, file, path, title, artist, album, track, genre, year,
+        duration):
+        self.file = file
+        self.path = path
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.track = track
+        self.genre = genre
+        self.year = year
+        self.duration = duration
+
+    @classmethod
+    def from_xbmc(cls, data, path, intern):
+        """
+        Build the record from a song dictionary returned by XBMC.
+        path is the file path relative to the music root, intern is used
+        to share the repeating tag values.
+        Tags that were not requested from XBMC are set to None.
+        """
+        return cls(
+            data['file'],
+            path,
+            data.get('title'),
+            intern(data.get('artist')),
+            intern(data.get('album')),
+            data.get('track'),
+            intern(data.get('genre')),
+            data.get('year'),
+            data.get('duration'))
+
+    def __getitem__(self, tag):
+        """
+        Dictionary-like access to the tags, song['artist'] works the same way
+        as with the raw XBMC data.
+        """
+        try:
+            return getattr(self, tag)
+        except AttributeError:
+            raise KeyError(tag)
+
+    def items(self):
+        """
+        Return list of (XBMC tag, value) pairs of the loaded tags.
+        """
+        return [(tag, getattr(self, tag)) for tag in self.TAGS
+            if getattr(self, tag) is not None]
+
+    def is_complete(self):
+        """
+        Return True if all tags of the song were loaded.
+        The track is not among the tags kept in memory when tags are loaded
+        lazily, XBMC sends it for every song when it is requested.
+        """
+        return self.track is not None
+
+    def matches(self, data):
+        """
+        Are the tags of the song equal to the ones in the song dictionary
+        from XBMC? Tags not present in data are ignored.
+        """
+        for tag in self.TAGS:
+            if tag in data and getattr(self, tag) != data[tag]:
+                return False
+        return True
+
+    def _key(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, Song):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        if not isinstance(other, Song):
+            return NotImplemented
+        return self._key() != other._key()
+
+
+def song_block(song):
+    """
+    Return the song encoded as lines of the MPD protocol (without position
+    and id), as UTF-8 bytes.
+    """
+    lines = [u'file: {}\n'.format(song.path)]
+    for tag, value in song.items():
+        if tag in MPD_TAGS:
+            lines.append(u'{}: {}\n'.format(MPD_TAGS[tag], value))
+
+    return u''.join(lines).encode('utf8')
+
+
+def song_size(song):
+    """
+    Estimate number of bytes used by a single song, including its values.
+    """
+    return sys.getsizeof(song) + \
+        sum(sys.getsizeof(getattr(song, slot)) for slot in Song.__slots__)
+
+
+def memory_usage(songs):
+    """
+    Estimate number of bytes used by the list of songs.
+    Shared (interned) values are counted only once.
+    """
+    seen = set()
+    total = sys.getsizeof(songs)
+
+    for song in songs:
+        total += sys.getsizeof(song)
+        for slot in Song.__slots__:
+            value = getattr(song, slot)
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+
+    return total
+
+
+def aggregate(songs, tags):
+    """
+    Group songs by values of tags in a single pass.
+    Returns dict mapping tuples of tag values to [count, playtime].
+    """
+    groups = {}
+    key = operator.itemgetter(*tags)
+
+    for song in songs:
+        value = key(song)
+        if len(tags) == 1:
+            value = (value,)
+
+        group = groups.get(value)
+        if group is None:
+            group = groups[value] = [0, 0]
+        group[0] += 1
+        group[1] += song['duration'] or 0
+
+    return groups
+
+
+class SongCache(object):
+    """
+    Least recently used cache of completely loaded songs, indexed by
+    XBMC path and bounded by estimated memory use.
+    """
+
+    def __init__(self, budget):
+        self._budget = budget
+        self._used = 0
+        self._songs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file):
+        """
+        Return the cached song or None.
+        """
+        with self._lock:
+            try:
+                song, size = self._songs.pop(file)
+            except KeyError:
+                return None
+
+            self._songs[file] = (song, size)
+            return song
+
+    def __contains__(self, file):
+        with self._lock:
+            return file in self._songs
+
+    def discard(self, file):
+        """
+        Remove song with the given path from the cache, if it is there.
+        """
+        with self._lock:
+            old = self._songs.pop(file, None)
+            if old is not None:
+                self._used -= old[1]
+
+    def put(self, song):
+        """
+        Add song to the cache, evicting the least recently used ones if
+        the memory budget is exceeded.
+        """
+        size = song_size(song)
+
+        with self._lock:
+            old = self._songs.pop(song.file, None)
+            if old is not None:
+                self._used -= old[1]
+
+            self._songs[song.file] = (song, size)
+            self._used += size
+
+            while self._used > self._budget and self._songs:
+                file, (evicted, evicted_size) = self._songs.popitem(last=False)
+                self._used -= evicted_size
+
+
+def _spliced(data, runs, length, value):
+    """
+    Return array of length items for a new list of songs. Items of the
+    unchanged songs in runs are copied from data by ranges, value(position)
+    is called for the remaining positions.
+    """
+    spliced = array.array(data.typecode)
+    start = 0
+    for new, old, count in runs:
+        spliced.extend(value(position) for position in xrange(start, new))
+        spliced.extend(data[old:old + count])
+        start = new + count
+    spliced.extend(value(position) for position in xrange(start, length))
+    return spliced
+
+
+def _uncovered(ranges, length):
+    """
+    Return list of positions below length not covered by sorted
+    (start, count) ranges.
+    """
+    positions = []
+    end = 0
+    for start, count in ranges:
+        positions.extend(xrange(end, start))
+        end = start + count
+    positions.extend(xrange(end, length))
+    return positions
+
+
+def _bisect(order, key, position_key):
+    """
+    Return index of the first position in order whose position_key
+    is not less than key.
+    """
+    low = 0
+    high = len(order)
+    while low < high:
+        middle = (low + high) // 2
+        if position_key(order[middle]) < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class Overlay(object):
+    """
+    Read only mapping made of a shared base dictionary and changes to it.
+    Lets a new snapshot update a large index of the previous one without
+    copying it.
+    """
+
+    # Marks keys removed from the base in the changes.
+    REMOVED = object()
+
+    # Changes are merged into a new dictionary when there are more of them
+    # than this fraction of the base.
+    MAX_CHANGES = 0.125
+
+    def __init__(self, base, changes):
+        self._base = base
+        self._changes = changes
+
+    @classmethod
+    def updated(cls, mapping, changes):
+        """
+        Return mapping (a dictionary or an Overlay) with the changes,
+        values REMOVED remove the key.
+        """
+        if isinstance(mapping, Overlay):
+            base = mapping._base
+            merged = dict(mapping._changes)
+            merged.update(changes)
+        else:
+            base = mapping
+            merged = changes
+
+        overlay = cls(base, merged)
+        if len(merged) <= len(base) * cls.MAX_CHANGES:
+            return overlay
+        return overlay.merged()
+
+    def merged(self):
+        """
+        Return a dictionary with the changes applied to the base.
+        """
+        result = dict(self._base)
+        for key, value in self._changes.iteritems():
+            if value is self.REMOVED:
+                result.pop(key, None)
+            else:
+                result[key] = value
+        return result
+
+    def __reduce__(self):
+        # REMOVED doesn't survive pickling, other processes get a dictionary.
+        return (dict, (self.merged(),))
+
+    def get(self, key, default=None):
+        value = self._changes.get(key, self._base.get(key, default))
+        if value is self.REMOVED:
+            return default
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self.REMOVED)
+        if value is self.REMOVED:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self.REMOVED) is not self.REMOVED
+
+
+class DictionaryColumn(object):
+    """
+    Tag values of all songs stored as integer codes into a dictionary
+    of distinct values.
+    """
+
+    def __init__(self, values):
+        self.dictionary = []
+        self._codes = {}
+        self.data = array.array('i', (self._encode(value) for value in values))
+
+    def _encode(self, value):
+        key = unicode(value)
+        code = self._codes.get(key)
+        if code is None:
+            code = len(self.dictionary)
+            self._codes[key] = code
+            self.dictionary.append(value)
+        return code
+
+    def updated(self, songs, tag, runs):
+        """
+        Return a column for a new list of songs.
+        Codes of the unchanged songs in runs are copied, only the remaining
+        songs are encoded.
+        """
+        column = DictionaryColumn(())
+        column.dictionary = list(self.dictionary)
+        column._codes = dict(self._codes)
+        column.data = _spliced(self.data, runs, len(songs),
+            lambda position: column._encode(songs[position][tag]))
+        return column
+
+    def mask(self, text):
+        """
+        Return list of booleans, true for songs whose value is equal to text.
+        """
+        code = self._codes.get(text, -1)
+        return list(itertools.imap(operator.eq,
+            self.data, itertools.repeat(code)))
+
+
+class NumericColumn(object):
+    """
+    Integer tag values of all songs.
+    """
+
+    def __init__(self, values):
+        self.data = array.array('i', values)
+
+    def updated(self, songs, tag, runs):
+        """
+        Return a column for a new list of songs.
+        Values of the unchanged songs in runs are copied.
+        """
+        column = NumericColumn(())
+        column.data = _spliced(self.data, runs, len(songs),
+            lambda position: songs[position][tag] or 0)
+        return column
+
+    def mask(self, text):
+        """
+        Return list of booleans, true for songs whose value formats to text.
+        """
+        try:
+            value = int(text)
+        except ValueError:
+            value = None
+
+        if value is None or unicode(value) != text:
+            return [False] * len(self.data)
+
+        return list(itertools.imap(operator.eq,
+            self.data, itertools.repeat(value)))
+
+
+class Columns(object):
+    """
+    Columnar representation of the library used for filtering whole
+    library at once.
+    """
+
+    DICTIONARY_TAGS = ('artist', 'album', 'genre', 'year')
+    NUMERIC_TAGS = ('track', 'duration')
+
+    def __init__(self, songs, tags):
+        self._columns = {}
+        for tag in self.DICTIONARY_TAGS:
+            if tag in tags:
+                self._columns[tag] = \
+                    DictionaryColumn(song[tag] for song in songs)
+        for tag in self.NUMERIC_TAGS:
+            if tag in tags:
+                self._columns[tag] = \
+                    NumericColumn(song[tag] or 0 for song in songs)
+
+    def updated(self, songs, runs):
+        """
+        Return columns for a new list of songs.
+        runs are the ranges of unchanged songs, as in Library.updated.
+        """
+        columns = Columns((), ())
+        for tag, column in self._columns.items():
+            columns._columns[tag] = column.updated(songs, tag, runs)
+        return columns
+
+    def __contains__(self, tag):
+        return tag in self._columns
+
+    def __getitem__(self, tag):
+        return self._columns[tag]
+
+    def mask(self, rules):
+        """
+        Return a mask of songs matching all of the (tag, value) rules.
+        All tags must be present in the columns.
+        """
+        mask = None
+        for tag, value in rules:
+            column_mask = self._columns[tag].mask(value)
+            if mask is None:
+                mask = column_mask
+            else:
+                mask = map(operator.and_, mask, column_mask)
+
+        return mask
+
+
+class Playlist(tuple):
+    """
+    Songs of the current playlist.
+    Indexes from tag values to playlist positions are built on first use.
+    """
+
+    def __init__(self, songs=()):
+        self._indexes = {}
+
+    def _index(self, tag):
+        index = self._indexes.get(tag)
+        if index is None:
+            index = {}
+            for position, song in enumerate(self):
+                index.setdefault(unicode(song[tag]), []).append(position)
+            self._indexes[tag] = index
+
+        return index
+
+    def positions(self, tag, value):
+        """
+        Return list of positions of songs whose tag is equal to value.
+        Tag 'path' matches the MPD path of songs.
+        """
+        return self._index(tag).get(value, [])
+
+    def search(self, tag, predicate):
+        """
+        Return sorted list of positions of songs whose tag satisfies
+        the predicate. The predicate is evaluated once per distinct value.
+        """
+        positions = []
+        for value, found in self._index(tag).iteritems():
+            if predicate(value):
+                positions.extend(found)
+
+        positions.sort()
+        return positions
+
+
+class Library(object):
+    """
+    Snapshot of the whole music library.
+    Optionally keeps a columnar copy of the tags for faster filtering.
+    tags is the collection of tags loaded for every song.
+    The library is never modified after it is created.
+    """
+
+    # The library is built again instead of updated when more than this
+    # fraction of the songs changed.
+    MAX_CHURN = 0.25
+
+    def __init__(self, songs, columnar=False, tags=Song.TAGS):
+        self.songs = tuple(songs)
+        self.by_path = {song.path: song for song in songs}
+        self._positions = None
+        self._orders = {}
+        self._tags = tags
+
+        # Pre-encoded blocks of the songs (libraryfile.LibraryFile) or None.
+        self.blocks = None
+
+        if columnar:
+            self.columns = Columns(songs, tags)
+        else:
+            self.columns = None
+
+    def position(self, song):
+        """
+        Return index of the song in the library or None if it is not present.
+        """
+        return self.file_position(song.file)
+
+    def file_position(self, file):
+        """
+        Return index of the song with given XBMC path or None.
+        """
+        if self._positions is None:
+            self._positions = dict(itertools.izip(
+                itertools.imap(operator.attrgetter('file'), self.songs),
+                itertools.count()))
+
+        return self._positions.get(file)
+
+    def song_block(self, song):
+        """
+        Return the pre-encoded block of a song from this library, or None
+        if it is not available.
+        """
+        if self.blocks is None:
+            return None
+
+        position = self.position(song)
+        if position is None or self.songs[position] is not song:
+            return None
+
+        return self.blocks[position]
+
+    def updated(self, songs, runs, added, removed):
+        """
+        Return a new library with the given songs, updating the indexes of
+        this one only for the changed songs.
+
+        runs is a list of (new position, old position, count) ranges of
+        unchanged songs, sorted by the new position. The songs outside of
+        them are new or modified.
+        added are the new and modified songs, removed are the removed songs
+        and the original versions of modified ones.
+
+        The library is built again if many songs changed or if unchanged
+        songs were reordered.
+        """
+        songs = tuple(songs)
+
+        if len(added) + len(removed) > self.MAX_CHURN * len(songs) or \
+            any(a[1] + a[2] > b[1] for a, b in itertools.izip(runs, runs[1:])):
+            return Library(songs, self.columns is not None, self._tags)
+
+        updated = Library.__new__(Library)
+        updated.songs = songs
+        updated._tags = self._tags
+        updated.blocks = None
+
+        changes = {song.path: Overlay.REMOVED for song in removed}
+        changes.update((song.path, song) for song in added)
+        updated.by_path = Overlay.updated(self.by_path, changes)
+
+        # Positions of the changed songs in both libraries.
+        new_positions = _uncovered(
+            [(new, count) for new, old, count in runs], len(songs))
+        old_positions = _uncovered(
+            [(old, count) for new, old, count in runs], len(self.songs))
+
+        # Unchanged songs keep their positions unless songs before them
+        # were removed or added.
+        in_place = all(new == old for new, old, count in runs)
+
+        if in_place and self._positions is not None:
+            changes = {self.songs[old].file: Overlay.REMOVED
+                for old in old_positions}
+            changes.update((songs[new].file, new) for new in new_positions)
+            updated._positions = Overlay.updated(self._positions, changes)
+        else:
+            updated._positions = None
+
+        if in_place:
+            old_to_new = None
+        else:
+            old_to_new = array.array('i', [-1]) * len(self.songs)
+            for new, old, count in runs:
+                old_to_new[old:old + count] = \
+                    array.array('i', xrange(new, new + count))
+
+        updated._orders = {tag: self._updated_order(updated, tag,
+                old_positions, new_positions, old_to_new)
+            for tag in self._orders}
+
+        if self.columns is None:
+            updated.columns = None
+        else:
+            updated.columns = self.columns.updated(songs, runs)
+
+        return updated
+
+    def _updated_order(self, updated, tag, old_positions, new_positions,
+        old_to_new):
+        """
+        Return order of the updated library by the tag, made from the order
+        of this one by removing songs at old_positions and inserting
+        songs at new_positions.
+        old_to_new maps positions of unchanged songs in this library to the
+        updated one, it is None if they didn't move.
+        """
+        order = self._orders[tag]
+
+        # Orders are sorted by the tag and then by position.
+        def old_key(position):
+            return (self.songs[position][tag], position)
+
+        def new_key(position):
+            return (updated.songs[position][tag], position)
+
+        kept = array.array('i')
+        start = 0
+        for index in sorted(_bisect(order, old_key(position), old_key)
+                for position in old_positions):
+            kept.extend(order[start:index])
+            start = index + 1
+        kept.extend(order[start:])
+
+        if old_to_new is not None:
+            kept = array.array('i', itertools.imap(old_to_new.__getitem__, kept))
+
+        result = array.array('i')
+        start = 0
+        inserted = sorted((_bisect(kept, new_key(position), new_key),
+                new_key(position)) for position in new_positions)
+        for index, (value, position) in inserted:
+            result.extend(kept[start:index])
+            result.append(position)
+            start = index
+        result.extend(kept[start:])
+        return result
+
+    def __len__(self):
+        return len(self.songs)
+
+    def __iter__(self):
+        return iter(self.songs)
+
+    def __eq__(self, other):
+        if not isinstance(other, Library):
+            return NotImplemented
+        return self.songs == other.songs
+
+    def __ne__(self, other):
+        if not isinstance(other, Library):
+            return NotImplemented
+        return self.songs != other.songs
+
+    def _split_rules(self, rules):
+        """
+        Split list of (tag, value) rules to a mask of songs satisfying the
+        rules that can be answered from columns and list of remaining rules.
+        Mask is None if no rule could be used.
+        """
+        if self.columns is None:
+            return None, rules
+
+        indexed = [rule for rule in rules if rule[0] in self.columns]
+        remaining = [rule for rule in rules if rule[0] not in self.columns]
+
+        return self.columns.mask(indexed), remaining
+
+    def order(self, tag):
+        """
+        Return array of song positions sorted by the tag.
+        The order is computed on first use and kept with the snapshot.
+        """
+        order = self._orders.get(tag)
+        if order is None:
+            songs = self.songs
+            order = array.array('i', sorted(xrange(len(songs)),
+                key=lambda i: songs[i][tag]))
+            self._orders[tag] = order
+
+        return order
+
+    def select(self, rules, sort=None, reverse=False):
+        """
+        Return iterable of songs whose tags are equal to all (tag, value) rules.
+        If sort is given, songs are ordered by this tag.
+        """
+        mask, remaining = self._split_rules(rules)
+
+        if sort is not None:
+            order = self.order(sort)
+            if reverse:
+                order = reversed(order)
+
+            if mask is None:
+                songs = itertools.imap(self.songs.__getitem__, order)
+            else:
+                songs = (self.songs[i] for i in order if mask[i])
+        elif mask is None:
+            songs = self.songs
+        else:
+            songs = itertools.compress(self.songs, mask)
+
+        if not remaining:
+            return songs
+
+        def predicate(song):
+            return all(unicode(song[tag]) == value for tag, value in remaining)
+
+        return itertools.ifilter(predicate, songs)
+
+    def count(self, rules):
+        """
+        Return tuple with number of songs matching the rules and their
+        total duration.
+        """
+        mask, remaining = self._split_rules(rules)
+
+        if mask is not None and not remaining and 'duration' in self.columns:
+            return (sum(mask),
+                sum(itertools.compress(self.columns['duration'].data, mask)))
+
+        count = 0
+        playtime = 0
+        for song in self.select(rules):
+            count += 1
+            playtime += song.duration
+
+        return count, playtime
+
+    def group(self, tags, rules):
+        """
+        Group songs matching the rules by values of tags.
+        Returns dict mapping tuples of tag values to [count, playtime].
+        """
+        mask, remaining = self._split_rules(rules)
+
+        if remaining or self.columns is None or \
+            not all(tag in self.columns and
+                isinstance(self.columns[tag], DictionaryColumn)
+                for tag in tags):
+            return aggregate(self.select(rules), tags)
+
+        columns = [self.columns[tag] for tag in tags]
+        if 'duration' in self.columns:
+            durations = self.columns['duration'].data
+        else:
+            durations = [song.duration for song in self.songs]
+
+        positions = xrange(len(self.songs))
+        if mask is not None:
+            positions = itertools.compress(positions, mask)
+
+        coded = {}
+        for i in positions:
+            key = tuple(column.data[i] for column in columns)
+            group = coded.get(key)
+            if group is None:
+                group = coded[key] = [0, 0]
+            group[0] += 1
+            group[1] += durations[i] or 0
+
+        return {tuple(column.dictionary[code]
+                    for column, code in itertools.izip(columns, key)): group
+                for key, group in coded.iteritems()}
+
+    def tag_values(self, tag, rules):
+        """
+        Return set of distinct values of tag among songs matching the rules.
+        """
+        mask, remaining = self._split_rules(rules)
+
+        if mask is not None and not remaining and tag in self.columns:
+            column = self.columns[tag]
+            if isinstance(column, DictionaryColumn):
+                codes = set(itertools.compress(column.data, mask))
+                return set(column.dictionary[code] for code in codes)
+
+        return set(song[tag] for song in self.select(rules))
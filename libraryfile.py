@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of xbmcpd.
+
+# xbmcpd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# xbmcpd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with xbmcpd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Library snapshot stored in a single file that is memory mapped.
+
+Layout (all integers little endian):
+    header
+    value offsets      (value count + 1) * uint32
+    values             type character ('u' or 'i') and UTF-8 text
+    songs              song count * len(FIELDS) * int32, index of value or -1
+    block offsets      (song count + 1) * uint32
+    blocks             songs encoded as MPD protocol lines
+"""
+
+import array
+import mmap
+import os
+import sys
+import struct
+import logging
+
+import library
+
+MAGIC = 'XBMCPDL1'
+
+# magic, identifier, song count, value count, probe total, probe last id,
+# bit mask of stored tags
+HEADER = struct.Struct('<8sQIIqqI')
+
+FIELDS = library.Song.__slots__
+
+
+def _array(typecode, data):
+    result = array.array(typecode)
+    result.fromstring(data)
+    if sys.byteorder != 'little':
+        result.byteswap()
+    return result
+
+
+def _bytes(values):
+    if sys.byteorder != 'little':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+def _encode_value(value):
+    if isinstance(value, (int, long)):
+        return 'i' + str(value)
+    else:
+        return 'u' + unicode(value).encode('utf8')
+
+
+def _decode_value(data):
+    if data[0] == 'i':
+        return int(data[1:])
+    else:
+        return data[1:].decode('utf8')
+
+
+def save(path, songs, probe, tags):
+    """
+    Write the songs to the file at path, replacing it atomically.
+    probe is the library probe value the songs correspond to and tags
+    the set of tags loaded in the songs.
+    Songs that have all their tags loaded get a pre-encoded block.
+    """
+    values = []
+    codes = {}
+    table = array.array('i')
+
+    for song in songs:
+        for field in FIELDS:
+            value = getattr(song, field)
+            if value is None:
+                table.append(-1)
+                continue
+
+            encoded = _encode_value(value)
+            code = codes.get(encoded)
+            if code is None:
+                code = codes[encoded] = len(values)
+                values.append(encoded)
+            table.append(code)
+
+    blocks = [library.song_block(song) if song.is_complete() else ''
+        for song in songs]
+
+    probe_total, probe_last = probe
+    mask = sum(1 << i for i, tag in enumerate(library.Song.TAGS) if tag in tags)
+    header = HEADER.pack(MAGIC, struct.unpack('<Q', os.urandom(8))[0],
+        len(songs), len(values), probe_total,
+        -1 if probe_last is None else probe_last, mask)
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(header)
+        f.write(_bytes(_offsets(values)))
+        f.write(''.join(values))
+        f.write(_bytes(table))
+        f.write(_bytes(_offsets(blocks)))
+        f.write(''.join(blocks))
+
+    os.rename(temp_path, path)
+
+
+def _offsets(chunks):
+    offsets = array.array('I', [0])
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        offsets.append(total)
+    return offsets
+
+
+def _reopen(path, identifier):
+    """
+    Map the file again in another process, return None if it was replaced.
+    """
+    try:
+        mapped = LibraryFile(path)
+    except (IOError, ValueError):
+        return None
+
+    if mapped.identifier != identifier:
+        return None
+
+    return mapped
+
+
+class LibraryFile(object):
+    """
+    Read only library file mapped in memory.
+    Indexing returns the pre-encoded block of the song at that position,
+    or None if the song has no block.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < HEADER.size:
+            raise ValueError('library file is truncated')
+
+        (magic, self.identifier, self.count, value_count, probe_total,
+            probe_last, mask) = HEADER.unpack_from(self._map)
+
+        if magic != MAGIC:
+            raise ValueError('not a library file')
+
+        self.probe = (probe_total, None if probe_last == -1 else probe_last)
+        self.tags = {tag for i, tag in enumerate(library.Song.TAGS)
+            if mask & (1 << i)}
+
+        position = HEADER.size
+        size = (value_count + 1) * 4
+        self._value_offsets = _array('I', self._map[position:position + size])
+        position += size
+
+        self._values_start = position
+        position += self._value_offsets[-1]
+
+        self._songs_start = position
+        position += self.count * len(FIELDS) * 4
+
+        size = (self.count + 1) * 4
+        self._block_offsets = _array('I', self._map[position:position + size])
+        position += size
+
+        self._blocks_start = position
+
+    def songs(self):
+        """
+        Return list of songs stored in the file.
+        Each distinct value is decoded only once and shared by the songs.
+        """
+        offsets = self._value_offsets
+        start = self._values_start
+        values = [
+            _decode_value(self._map[start + offsets[i]:start + offsets[i + 1]])
+            for i in xrange(len(offsets) - 1)]
+        values.append(None) # index -1
+
+        songs_end = self._songs_start + self.count * len(FIELDS) * 4
+        table = _array('i', self._map[self._songs_start:songs_end])
+
+        width = len(FIELDS)
+        return [library.Song(*[values[code] for code in table[i:i + width]])
+            for i in xrange(0, len(table), width)]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        """
+        The block is copied from the mapping to a string. Twisted's transport
+        and the joining of buffered responses accept only strings, a buffer
+        of the mapping would be copied by them anyway. The song is still not
+        formatted and encoded again.
+        """
+        start = self._blocks_start + self._block_offsets[position]
+        end = self._blocks_start + self._block_offsets[position + 1]
+
+        if start == end:
+            return None
+
+        return self._map[start:end]
+
+    def __reduce__(self):
+        return (_reopen, (self.path, self.identifier))
+
+
+def load(path):
+    """
+    Return the library file at path, or None if it is missing or invalid.
+    """
+    try:
+        return LibraryFile(path)
+    except (IOError, ValueError) as e:
+        logging.warning(u'library file {} not used: {}'.format(path, e))
+        return None
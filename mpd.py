@@ -16,15 +16,22 @@
 # You should have received a copy of the GNU General Public License
 # along with xbmcpd.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import itertools
 import logging
 import re
+import time
 import operator
 import twisted.internet.reactor
 import twisted.internet.protocol
+import twisted.internet.threads
 import twisted.protocols.basic
 from pprint import pprint
 
+import library
+import xbmc
+import art
+
 class MPDError(Exception):
     ACK_ERROR_NOT_LIST = 1
     ACK_ERROR_ARG = 2
@@ -112,7 +119,10 @@ class Argument(unicode):
                 end = start + 1
             elif len(split) == 2:
                 start = int(split[0])
-                end = int(split[1])
+                if split[1]:
+                    end = int(split[1])
+                else:
+                    end = None
             else:
                 self._exception(u'need a range')
 
@@ -153,56 +163,98 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         'command_list_end', 'commands', 'close',
         'notcommands', 'outputs', 'tagtypes',
         'playid','stop','seek', 'shuffle', 'playlistinfo', 'playlistid',
+        'playlistfind', 'playlistsearch',
+        'listplaylists', 'listplaylist', 'listplaylistinfo',
+        'load', 'save', 'rm',
+        'albumart', 'readpicture', 'binarylimit',
         'plchanges', 'plchangesposid', 'idle',
         'listall', 'listallinfo'}
 
+    # Version of the MPD protocol sent to clients. Clients use window, sort
+    # and group only with servers of at least 0.21. Filter expressions of
+    # that version are supported only partly, see _filter_arguments.
+    PROTOCOL_VERSION = u'0.21.0'
+
+    # Tokens of filter expressions: parentheses, AND, comparison operators,
+    # quoted strings and words.
+    FILTER_TOKEN = re.compile(ur'''\s*(?:
+        (?P<paren>[()]) |
+        (?P<operator>==|!=|=~|!~|!) |
+        "(?P<double>(?:[^"\\]|\\.)*)" |
+        '(?P<single>(?:[^'\\]|\\.)*)' |
+        (?P<word>[^\s()"'=!~]+)
+        )''', re.X | re.U)
+
+    # Subsystems of MPD's idle command, each has one bit in the pending
+    # changes. The ones after 'options' are accepted but never reported.
+    IDLE_SUBSYSTEMS = ('database', 'update', 'stored_playlist', 'playlist',
+        'player', 'mixer', 'output', 'options', 'partition', 'sticker',
+        'subscription', 'message', 'neighbor', 'mount')
+    IDLE_ALL = (1 << len(IDLE_SUBSYSTEMS)) - 1
+
+    # Playlist editing commands that are sent to XBMC together when
+    # they follow each other in a command list.
+    BATCHED_COMMANDS = {'add', 'addid', 'deleteid'}
+
     # Tags that we support.
     # MPD tag -> XBMC tag
     # MPD tags must be capitalized!
-    MPD_TAG_TO_XBMC_TAG = {
-        'Artist': 'artist',
-        'Album': 'album',
-        'Title': 'title',
-        'Track': 'track',
-        'Genre': 'genre',
-        'Date': 'year',
-        'Time': 'duration'}
+    XBMC_TAG_TO_MPD_TAG = library.MPD_TAGS
+
+    MPD_TAG_TO_XBMC_TAG = {v:k for k, v in XBMC_TAG_TO_MPD_TAG.items()}
+
+    # Thread pool for executing commands, or None to execute them
+    # directly in the reactor thread.
+    thread_pool = None
 
-    XBMC_TAG_TO_MPD_TAG = {v:k for k, v in MPD_TAG_TO_XBMC_TAG.items()}
+    # Store of the stored playlists (playlists.PlaylistStore), or None.
+    playlists = None
+
+    # Recorder of the client commands (recorder.Recorder), or None.
+    recorder = None
+
+    # Size of binary chunks sent by albumart and readpicture, clients can
+    # change it with binarylimit.
+    BINARY_LIMIT = 8192
+    MIN_BINARY_LIMIT = 64
 
     def __init__(self):
         self.delimiter = '\n'
         self.command_list = []
         self.command_list_ok = False
         self.command_list_started = False
+        self.in_command_list = False
         self.command_list_position = 0
         self.current_command = ''
-        self.playlist_id = 1
+        self.view = None
         self.last_playlist = None
         self.idle_mode = False
 
-    def _xbmc_path_to_mpd_path(self, path):
-        """
-        Converts a path that xbmc uses (based at filesystem root)
-        to path format for mpd (relative to music path).
-        """
-        assert path.startswith(self.musicpath)
+        # Command list being received (processing of the previous one
+        # may still be running).
+        self._received_list = []
+        self._received_list_ok = False
 
-        path = path[len(self.musicpath):]
-        path = path.strip(self.xbmc.path_sep)
-        path = path.replace(self.xbmc.path_sep, '/')
+        # Command lists waiting for execution, None stands for noidle.
+        self._queue = collections.deque()
+        self._busy = False
+        self._output = None
+        self._idle_requested = False
 
-        return path
+        # Bitmask of changes not reported to the client yet and bitmask of
+        # subsystems the running idle command waits for.
+        self._pending_changes = 0
+        self._idle_mask = self.IDLE_ALL
+
+        self.binary_limit = self.BINARY_LIMIT
+
+        self.connection_id = None
 
     def _mpd_path_to_xbmc_path(self, path):
         """
         Converts a path suitable for MPD to path for XBMC
-        Almost inverse for _xbmc_path_to_mpd_path()
         """
-
-        path = path.replace('/', self.xbmc.path_sep)
-        path = self.musicpath + self.xbmc.path_sep + path
-        return path
+        return self.xbmc.mpd_path_to_xbmc_path(path)
 
     def _send_lists(self, datalist):
         """
@@ -213,9 +265,15 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
 
     def _send_song(self, song, pos = None, ident = None):
         """
-        Sends a single song and its metadata from an XBMC song object.
+        Sends a single song and its metadata from a song record.
         """
-        lines = [('file', self._xbmc_path_to_mpd_path(song['file']))]
+        if pos is None and ident is None:
+            block = self.view.all_songs.song_block(song)
+            if block is not None:
+                self._send_block(block)
+                return
+
+        lines = [('file', song.path)]
         for xbmctag, value in song.items():
             if xbmctag in self.XBMC_TAG_TO_MPD_TAG:
                 lines.append((self.XBMC_TAG_TO_MPD_TAG[xbmctag], value))
@@ -228,21 +286,87 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
             
         self._send_lists(lines)
 
-    def _send_path(self, label, xbmc_path):
+    def _dispatch(self, item):
         """
-        Send 'label: path' to client.
+        Queue a command list (tuple of commands, command_list_ok flag and
+        command list flag) or None for noidle, and start processing the queue.
         """
-        self._send_lists([(label, self._xbmc_path_to_mpd_path(xbmc_path))])
+        self._queue.append(item)
+        self._process_queue()
 
-    def _process_command_list(self):
+    def _process_queue(self):
+        """
+        Process queued command lists one at a time, either directly or in the
+        thread pool. Responses are sent in the order the commands came.
+        """
+        while self._queue and not self._busy:
+            item = self._queue.popleft()
+
+            if item is None:
+                self._noidle()
+            elif self.thread_pool is None:
+                self._process_command_list(*item)
+                self._command_list_done()
+            else:
+                self._busy = True
+                d = twisted.internet.threads.deferToThreadPool(
+                    twisted.internet.reactor, self.thread_pool,
+                    self._process_buffered, *item)
+                d.addCallbacks(self._buffered_done, self._buffered_failed)
+
+    def _process_buffered(self, *item):
+        """
+        Process a command list in a worker thread, return list of encoded
+        response chunks.
+        """
+        self._output = []
         try:
-            for i, command in enumerate(self.command_list):
-                logging.debug(u'command {} of {}: {}'.format(
-                    i, len(self.command_list), unicode(command)))
+            self._process_command_list(*item)
+            return self._output
+        finally:
+            self._output = None
 
-                #for nice error messages:
-                self.command_list_position = i
-                self.current_command = command.name()
+    def _buffered_done(self, output):
+        if output:
+            self.transport.write(''.join(output))
+
+        self._busy = False
+        self._command_list_done()
+        self._process_queue()
+
+    def _buffered_failed(self, failure):
+        logging.critical(u'Command processing failed!\n' + failure.getTraceback())
+        self._buffered_done([])
+
+    def _command_list_done(self):
+        """
+        Enter the idle mode if the finished command list asked for it.
+        """
+        if self._idle_requested:
+            self._idle_requested = False
+            self.idle_mode = True
+            self._wake()
+
+    def _process_command_list(self, command_list, command_list_ok,
+        in_command_list):
+        self.command_list = command_list
+        self.command_list_ok = command_list_ok
+        self.in_command_list = in_command_list
+
+        try:
+            i = 0
+            while i < len(self.command_list):
+                batch = list(itertools.takewhile(
+                    lambda c: c.name() in self.BATCHED_COMMANDS,
+                    self.command_list[i:]))
+
+                if len(batch) > 1:
+                    self._process_batch(i, batch)
+                    i += len(batch)
+                    continue
+
+                command = self.command_list[i]
+                self._start_command(i, command)
 
                 if command.name() not in self.SUPPORTED_COMMANDS:
                     self.current_command = ''
@@ -254,34 +378,144 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
 
                 if self.command_list_ok:
                     self._send_line(u'list_OK')
+
+                i += 1
         except MPDError as e:
+            command = self.command_list[e.position]
             logging.error(e.text + u' ({})'.format(unicode(command)))
             self._send_line(unicode(e))
+        except xbmc.XBMCUnavailable as e:
+            logging.error(u'XBMC unavailable: {}'.format(e))
+            self._send_line(unicode(MPDError(
+                self, MPDError.ACK_ERROR_SYSTEM, u'XBMC is not responding')))
+        except xbmc.TooManySongs as e:
+            logging.warning(u'refusing to load tags of {} songs'.format(e.count))
+            self._send_line(unicode(MPDError(self, MPDError.ACK_ERROR_ARG,
+                u'needs tags of {} songs that are not in memory, at most {} '
+                u'are loaded for a command; use more filters'.format(
+                    e.count, e.limit))))
         except Exception as e:
             logging.critical(u'Caught an exception!', exc_info=True)
             self._send_line(unicode(MPDError(
                 self, MPDError.ACK_ERROR_SYSTEM, u'Internal server error, sorry.')))
         else:
-            if not self.idle_mode:
+            if not self._idle_requested:
                 logging.debug(u'OK')
                 self._send_line('OK')
 
+    def _start_command(self, i, command):
+        logging.debug(u'command {} of {}: {}'.format(
+            i, len(self.command_list), unicode(command)))
+
+        #for nice error messages:
+        self.command_list_position = i
+        self.current_command = command.name()
+
+        self.view = self.xbmc.view()
+
+    def _process_batch(self, start, commands):
+        """
+        Process a run of playlist editing commands from a command list
+        using a single XBMC request.
+        Commands are processed up to the first invalid one, whose error is
+        raised after the preceding commands are done.
+        An XBMC error is reported for the command that failed.
+        """
+        operations = []
+        error = None
+        for i, command in enumerate(commands):
+            self._start_command(start + i, command)
+            try:
+                operations.append(self._playlist_operation(command))
+            except MPDError as e:
+                error = e
+                break
+
+        results = self.xbmc.edit_playlist(operations)
+
+        for i, (command, operation, (position, xbmc_error)) in \
+            enumerate(zip(commands, operations, results)):
+            self.command_list_position = start + i
+            self.current_command = command.name()
+
+            if xbmc_error == self.xbmc.BAD_POSITION:
+                if operation[0] == 'remove':
+                    raise MPDError(self, MPDError.ACK_ERROR_NO_EXIST,
+                        u'No such song')
+                raise MPDError(self, MPDError.ACK_ERROR_ARG,
+                    u'Bad song index')
+            elif xbmc_error is not None:
+                raise MPDError(self, MPDError.ACK_ERROR_SYSTEM,
+                    u'XBMC error: {}'.format(xbmc_error['message']))
+
+            if command.name() == 'addid' and position is not None:
+                self._send_lists([('Id', position)])
+
+            if self.command_list_ok:
+                self._send_line(u'list_OK')
+
+        if error is not None:
+            raise error
+
+    def _playlist_operation(self, command):
+        """
+        Convert add, addid or deleteid command to an operation for
+        XBMCControl.edit_playlist().
+        """
+        if command.name() == 'deleteid':
+            command.check_arg_count(1)
+            return ('remove', command.args[0].as_int())
+        elif command.name() == 'add':
+            command.check_arg_count(1)
+            return ('add', self._mpd_path_to_xbmc_path(command.args[0]))
+        else:
+            command.check_arg_count(1, 2)
+            path = self._mpd_path_to_xbmc_path(command.args[0])
+            if len(command.args) == 1:
+                return ('add', path)
+            else:
+                return ('insert', path, command.args[1].as_int())
+
     def _send_line(self, line):
         encoded = line.encode('utf8')
-        self.sendLine(encoded)
+        if self._output is None:
+            self.sendLine(encoded)
+        else:
+            self._output.append(encoded + self.delimiter)
+
+    def _send_block(self, block):
+        """
+        Send already encoded lines, including the delimiters.
+        """
+        if self._output is None:
+            self.transport.write(block)
+        else:
+            self._output.append(block)
 
     def connectionMade(self):
         self.xbmc.state.changed.subscribe(self._state_changed)
         self.xbmc.playlist.changed.subscribe(self._playlist_changed)
         self.xbmc.volume.changed.subscribe(self._volume_changed)
+        self.xbmc.all_songs.changed.subscribe(self._database_changed)
+        if self.playlists is not None:
+            self.playlists.changed.subscribe(self._stored_playlist_changed)
+
+        if self.recorder is not None:
+            self.connection_id = self.recorder.connection()
+            self.recorder.connected(self.connection_id)
 
-        self._send_line(u'OK MPD 0.16.0')
+        self._send_line(u'OK MPD {}'.format(self.PROTOCOL_VERSION))
         logging.info('Client connected.')
 
     def connectionLost(self, reason):
         self.xbmc.state.changed.unsubscribe(self._state_changed)
         self.xbmc.playlist.changed.unsubscribe(self._playlist_changed)
         self.xbmc.volume.changed.unsubscribe(self._volume_changed)
+        self.xbmc.all_songs.changed.unsubscribe(self._database_changed)
+        if self.playlists is not None:
+            self.playlists.changed.unsubscribe(self._stored_playlist_changed)
+        if self.recorder is not None:
+            self.recorder.disconnected(self.connection_id)
 
         logging.info('Client disconnected.')
 
@@ -297,55 +531,88 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
                 self, MPDError.ACK_ERROR_SYSTEM, u'Invalid utf-8.')))
             return
         data = data.rstrip(u'\r')
-            
+
+        if self.recorder is not None:
+            self.recorder.command(self.connection_id, data)
+
         command = Command(data, self)
 
-        if self.idle_mode:
-            if command.name() == u'noidle':
-                self._noidle()
+        if command.name() == u'noidle':
+            self._dispatch(None)
+        elif self.idle_mode:
+            pass
         elif command.name() == u'command_list_begin':
             logging.debug(u'command list started')
-            self.command_list = []
+            self._received_list = []
             self.command_list_started = True
-            self.command_list_ok = False
+            self._received_list_ok = False
         elif command.name() == u'command_list_ok_begin':
             logging.debug(u'command list started')
-            self.command_list = []
+            self._received_list = []
             self.command_list_started = True
-            self.command_list_ok = True
+            self._received_list_ok = True
         elif command.name() == u'command_list_end':
             logging.debug(u'command list ended')
-            self._process_command_list()
+            self._dispatch((self._received_list, self._received_list_ok, True))
             self.command_list_started = False
-            self.command_list_ok = False
+            self._received_list_ok = False
         elif self.command_list_started:
-            self.command_list.append(command)
+            self._received_list.append(command)
         else:
-            self.command_list = [command]
-            self._process_command_list()
+            self._dispatch(([command], False, False))
 
     def idle(self, command):
         """
-        Start the idle mode.
-        By setting the self.idle_mode flag this command gets a special
-        treatment -- 'OK' isn't sent after this is processed.
+        Start the idle mode, optionally waiting only for the given subsystems.
+        By setting the self._idle_requested flag this command gets a special
+        treatment -- 'OK' isn't sent after this is processed and the idle mode
+        starts once the response is sent.
         """
-        command.check_arg_count(0)
-
-        if self.command_list_started:
-            raise MPDError(MPDError.ACK_ERROR_SYSTEM, 
+        if self.in_command_list:
+            raise MPDError(self, MPDError.ACK_ERROR_SYSTEM,
                 u'idle inside command list is stupid')
 
-        self.idle_mode = True
+        mask = 0
+        for subsystem in command.args:
+            if subsystem not in self.IDLE_SUBSYSTEMS:
+                raise MPDError(self, MPDError.ACK_ERROR_ARG,
+                    u'Unrecognized idle event: {}'.format(subsystem))
+            mask |= 1 << self.IDLE_SUBSYSTEMS.index(subsystem)
+
+        self._idle_mask = mask or self.IDLE_ALL
+        self._idle_requested = True
 
-    def _noidle(self, *changed):
+    def _changed(self, subsystem):
         """
-        Cancel running idle command.
+        Remember a change of the subsystem and wake up the idle command
+        if it waits for it.
+        """
+        self._pending_changes |= 1 << self.IDLE_SUBSYSTEMS.index(subsystem)
+        self._wake()
+
+    def _wake(self):
+        """
+        End the idle mode if some of the pending changes are interesting
+        for the running idle command.
+        """
+        if self.idle_mode and self._pending_changes & self._idle_mask:
+            self._noidle()
+
+    def _noidle(self):
+        """
+        Cancel running idle command, report the pending changes of the
+        subsystems it waits for.
         If we're not in idle mode, do nothing.
         """
         if not self.idle_mode:
             return
 
+        reported = self._pending_changes & self._idle_mask
+        self._pending_changes &= ~reported
+        changed = [subsystem
+            for i, subsystem in enumerate(self.IDLE_SUBSYSTEMS)
+            if reported & (1 << i)]
+
         logging.debug(u'wake up (' + u', '.join(changed) + u')')
 
         self._send_lists(('changed', subsystem) for subsystem in changed)
@@ -355,7 +622,7 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
     def playlistinfo(self, command):
         command.check_arg_count(0, 1)
 
-        playlist = self.xbmc.playlist.value
+        playlist = self.view.playlist
 
         if len(command.args) == 1:
             limits = command.args[0].as_range()
@@ -369,7 +636,280 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
                 self._send_song(song, pos, pos)
 
     def playlistid(self, command):
-        self.playlistinfo(command)
+        """
+        Send a single song of the playlist by its id, or the whole playlist.
+        """
+        command.check_arg_count(0, 1)
+
+        if len(command.args) == 0:
+            self.playlistinfo(command)
+            return
+
+        playlist = self.view.playlist
+        song_id = command.args[0].as_int()
+
+        if not 0 <= song_id < len(playlist):
+            raise MPDError(self, MPDError.ACK_ERROR_NO_EXIST,
+                u'No such song')
+
+        self._send_song(playlist[song_id], song_id, song_id)
+
+    def _playlist_positions(self, filter_list, exact):
+        """
+        Return positions of the playlist songs that satisfy the filter list.
+        Candidates are taken from the playlist indexes and only they are
+        checked against the whole filter list.
+        """
+        playlist = self.view.playlist
+
+        if exact:
+            compare = operator.eq
+        else:
+            compare = lambda a, b: a.lower() in b.lower()
+
+        positions = None
+        for rule, value in filter_list:
+            if rule == 'Any':
+                continue
+            elif rule == 'File' or rule == 'Filename':
+                tag = 'path'
+            else:
+                tag = self.MPD_TAG_TO_XBMC_TAG[rule]
+
+            if exact:
+                found = playlist.positions(tag, value)
+            else:
+                found = playlist.search(tag, lambda text: compare(value, text))
+
+            if positions is None:
+                positions = set(found)
+            else:
+                positions.intersection_update(found)
+
+        if positions is None:
+            positions = xrange(len(playlist))
+
+        return [pos for pos in sorted(positions)
+            if self._filter_predicate(filter_list, compare, playlist[pos])]
+
+    def playlistfind(self, command):
+        """
+        Send songs of the playlist with tags exactly matching the filter.
+        """
+        # playlistfind artist "Bob Marley"
+
+        arguments = self._filter_arguments(command.args, u'==')
+
+        if len(arguments) < 2:
+            raise command.arg_count_exception()
+
+        filter_list = self._make_filter(arguments)
+        playlist = self.view.playlist
+
+        for pos in self._playlist_positions(filter_list, True):
+            self._send_song(playlist[pos], pos, pos)
+
+    def playlistsearch(self, command):
+        """
+        Send songs of the playlist with tags containing the filter values,
+        ignoring case.
+        """
+        arguments = self._filter_arguments(command.args, u'contains')
+
+        if len(arguments) < 2:
+            raise command.arg_count_exception()
+
+        filter_list = self._make_filter(arguments)
+        playlist = self.view.playlist
+
+        for pos in self._playlist_positions(filter_list, False):
+            self._send_song(playlist[pos], pos, pos)
+
+    def _playlist_store(self):
+        """
+        Return the store of stored playlists, or fail if there is none.
+        """
+        if self.playlists is None:
+            raise MPDError(self, MPDError.ACK_ERROR_SYSTEM,
+                u'stored playlists are disabled')
+
+        return self.playlists
+
+    def _stored_playlist(self, name):
+        """
+        Return tuple of MPD paths in a stored playlist.
+        """
+        try:
+            return self._playlist_store().get(name)
+        except KeyError:
+            raise MPDError(self, MPDError.ACK_ERROR_NO_EXIST,
+                u'No such playlist')
+        except ValueError as e:
+            raise MPDError(self, MPDError.ACK_ERROR_ARG, unicode(e))
+
+    def _send_stored_playlists(self):
+        for name, mtime in self._playlist_store().list():
+            self._send_lists([
+                ('playlist', name),
+                ('Last-Modified', time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                    time.gmtime(mtime)))])
+
+    def listplaylists(self, command):
+        """
+        List the stored playlists.
+        """
+        command.check_arg_count(0)
+        self._send_stored_playlists()
+
+    def listplaylist(self, command):
+        """
+        List paths of songs in a stored playlist.
+        """
+        command.check_arg_count(1)
+        self._send_lists(('file', path)
+            for path in self._stored_playlist(command.args[0]))
+
+    def listplaylistinfo(self, command):
+        """
+        List songs in a stored playlist with their tags.
+        Songs are taken from the library, paths that are not in it are
+        sent without tags.
+        """
+        command.check_arg_count(1)
+
+        paths = self._stored_playlist(command.args[0])
+        by_path = self.view.all_songs.by_path
+        songs = [by_path.get(path) for path in paths]
+        hydrated = iter(self.xbmc.hydrate(
+            song for song in songs if song is not None))
+
+        for path, song in itertools.izip(paths, songs):
+            if song is None:
+                self._send_lists([('file', path)])
+            else:
+                self._send_song(next(hydrated))
+
+    def load(self, command):
+        """
+        Add songs of a stored playlist (or a range of them) to the playlist,
+        all in a single batch.
+        Adding stops at the first song that XBMC fails to add, the client
+        gets an error that the playlist was loaded only partially.
+        """
+        command.check_arg_count(1, 2)
+
+        paths = self._stored_playlist(command.args[0])
+        if len(command.args) == 2:
+            limits = command.args[1].as_range()
+            paths = paths[limits['start']:limits['end']]
+
+        results = self.xbmc.edit_playlist([
+            ('add', self._mpd_path_to_xbmc_path(path)) for path in paths])
+
+        for path, (position, error) in itertools.izip(paths, results):
+            if error is not None:
+                raise MPDError(self, MPDError.ACK_ERROR_PLAYLIST_LOAD,
+                    u'Failed to add {}: {}'.format(path, error.get('message')))
+
+    def save(self, command):
+        """
+        Save the playlist as a stored playlist.
+        """
+        command.check_arg_count(1)
+        store = self._playlist_store()
+        name = command.args[0]
+
+        try:
+            if store.exists(name):
+                raise MPDError(self, MPDError.ACK_ERROR_EXIST,
+                    u'Playlist already exists')
+            store.save(name, [song.path for song in self.view.playlist])
+        except ValueError as e:
+            raise MPDError(self, MPDError.ACK_ERROR_ARG, unicode(e))
+
+    def rm(self, command):
+        """
+        Remove a stored playlist.
+        """
+        command.check_arg_count(1)
+
+        try:
+            self._playlist_store().remove(command.args[0])
+        except KeyError:
+            raise MPDError(self, MPDError.ACK_ERROR_NO_EXIST,
+                u'No such playlist')
+        except ValueError as e:
+            raise MPDError(self, MPDError.ACK_ERROR_ARG, unicode(e))
+
+    def _album_art(self, command):
+        """
+        Return album art of the song in the first argument and offset
+        from the second one.
+        """
+        command.check_arg_count(2)
+
+        path = command.args[0]
+        song = self.view.all_songs.by_path.get(path)
+        if song is not None:
+            xbmc_path = song.file
+        else:
+            xbmc_path = self._mpd_path_to_xbmc_path(path)
+
+        offset = command.args[1].as_int()
+        if offset < 0:
+            raise MPDError(self, MPDError.ACK_ERROR_ARG, u'Bad offset')
+
+        return self.xbmc.get_album_art(xbmc_path), offset
+
+    def _send_binary(self, data, offset, mime_type=None):
+        """
+        Send a chunk of data starting at offset, at most binary_limit bytes.
+        """
+        if offset > len(data):
+            raise MPDError(self, MPDError.ACK_ERROR_ARG, u'Offset too large')
+
+        chunk = data[offset:offset + self.binary_limit]
+
+        self._send_line(u'size: {}'.format(len(data)))
+        if mime_type is not None:
+            self._send_line(u'type: {}'.format(mime_type))
+        self._send_line(u'binary: {}'.format(len(chunk)))
+        self._send_block(chunk + self.delimiter)
+
+    def albumart(self, command):
+        """
+        Send a chunk of the album art of a song.
+        The image is cached, so reading the following chunks doesn't
+        download it again.
+        """
+        data, offset = self._album_art(command)
+        if not data:
+            raise MPDError(self, MPDError.ACK_ERROR_NO_EXIST, u'No file exists')
+
+        self._send_binary(data, offset)
+
+    def readpicture(self, command):
+        """
+        Send a chunk of the picture of a song, with its type.
+        XBMC doesn't give us embedded pictures, so this is the album art.
+        Sends an empty response when the song has no picture.
+        """
+        data, offset = self._album_art(command)
+        if not data:
+            return
+
+        self._send_binary(data, offset, art.image_type(data))
+
+    def binarylimit(self, command):
+        """
+        Set maximal size of binary chunks.
+        """
+        command.check_arg_count(1)
+        limit = command.args[0].as_int()
+        if limit < self.MIN_BINARY_LIMIT:
+            raise MPDError(self, MPDError.ACK_ERROR_ARG, u'Value too small')
+
+        self.binary_limit = limit
 
     def plchanges(self, command):
         """
@@ -378,7 +918,7 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         we don't care and say that everything is always changed.
         """
         command.check_arg_count(1)
-        for pos, song in enumerate(self.xbmc.playlist.value):
+        for pos, song in enumerate(self.view.playlist):
             self._send_song(song, pos, pos)
         
     def plchangesposid(self, command):
@@ -388,7 +928,7 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         we don't care and say that everything is always changed.
         """
         command.check_arg_count(1)
-        for i in range(len(self.xbmc.playlist.value)):
+        for i in range(len(self.view.playlist)):
             self._send_lists([('cpos', i), ('Id', i)])
 
     def status(self, command):
@@ -397,15 +937,24 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         """
         command.check_arg_count(0)
     
-        playlist_state = self.xbmc.state.value
-        time = self.xbmc.get_time()
+        playlist_state = self.view.state
+        stale = self.view.stale
+        try:
+            time = self.xbmc.get_time()
+        except xbmc.XBMCUnavailable:
+            time = None
+            stale = True
 
         
         self._send_lists([
-            ('volume', self.xbmc.volume.value),
+            ('volume', self.view.volume),
             ('consume', 0),
-            ('playlist', self.playlist_id),
-            ('playlistlength', len(self.xbmc.playlist.value))])
+            ('playlist', self.view.playlist_version),
+            ('playlistlength', len(self.view.playlist))])
+
+        if stale:
+            self._send_lists([
+                ('error', u'XBMC is not responding, showing cached state')])
 
         if playlist_state is None or time is None:
             self._send_lists([
@@ -435,11 +984,12 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
                 ('repeat', 0),
                 ('single', 0)])
             
-        self._send_lists([
-            ('state', state),
-            ('song', playlist_state['current']),
-            ('songid', playlist_state['current']),
-            ('time', '{}:{}'.format(*time))])
+        self._send_lists([('state', state)])
+        if playlist_state['current'] is not None:
+            self._send_lists([
+                ('song', playlist_state['current']),
+                ('songid', playlist_state['current'])])
+        self._send_lists([('time', '{}:{}'.format(*time))])
 
     def stats(self, command):
         """
@@ -447,7 +997,7 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         """
         playtime = 0
 
-        songs = self.xbmc.all_songs.value
+        songs = self.view.all_songs
         artists = set()
         albums = set()
 
@@ -531,12 +1081,12 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         path = self._mpd_path_to_xbmc_path(command.args[0])
 
         if len(command.args) == 1:
-            index = len(self.xbmc.playlist.value)
+            index = len(self.view.playlist)
             self.xbmc.add_to_playlist(path)
             self._send_lists([('Id', index)])
         else:
             position = command.args[1].as_int()
-            self.xbmc.insert_into_playlist(position, path)
+            self.xbmc.insert_into_playlist(path, position)
             self._send_lists([('Id', position)])
 
     def clear(self, command):
@@ -598,6 +1148,7 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         List command.
         """
         # list genre album "Café del Mar, volumen seis" artist "A New Funky Generation"
+        # list album group date group artist
 
         if len(command.args) == 0:
             raise command.arg_count_exception()
@@ -607,21 +1158,166 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         if tagtype not in self.MPD_TAG_TO_XBMC_TAG:
             raise MPDError(self, MPDError.ACK_ERROR_ARG,
                 u'"{}" is not known'.format(command.args[0]))
-            
-        if len(command.args) == 2:
+
+        arguments, groups = self._split_group_args(command.args[1:])
+        arguments = self._filter_arguments(arguments, u'==')
+
+        if len(arguments) == 1:
             if tagtype == 'Album':
-                filter_list = {'Album': command.args[1]}
+                filter_list = [('Artist', arguments[0])]
             else:
                 raise MPDError(self, MPDError.ACK_ERROR_ARG, 
                     u'tag type must be "Album" for 2 argument version')
         else:
-            filter_list = self._make_filter(command.args[1:])
+            filter_list = self._make_filter(arguments)
+
+        xbmctag = self.MPD_TAG_TO_XBMC_TAG[tagtype]
+
+        if groups:
+            self._send_groups(groups + [tagtype],
+                self._aggregate(filter_list, groups + [tagtype]), False)
+            return
 
-        tags = set((song[self.MPD_TAG_TO_XBMC_TAG[tagtype]] for
-            song in self._filtered_songs(filter_list)))
+        rules, remaining = self._library_rules(filter_list)
+
+        if xbmctag not in self.xbmc.resident_tags:
+            tags = set((song[xbmctag] for song in
+                self.xbmc.hydrate_all(self._filtered_songs(filter_list))))
+        elif remaining:
+            tags = set((song[xbmctag] for
+                song in self._filtered_songs(filter_list)))
+        else:
+            tags = self.view.all_songs.tag_values(xbmctag, rules)
 
         self._send_lists([(tagtype, tag) for tag in tags])
     
+    def _split_group_args(self, arguments):
+        """
+        Separate the trailing "group TAG" arguments of list and count.
+        Returns the remaining arguments and list of MPD group tags.
+        """
+        arguments = list(arguments)
+        groups = []
+
+        while len(arguments) >= 2 and arguments[-2].lower() == u'group':
+            tag = arguments[-1].capitalize()
+            if tag not in self.MPD_TAG_TO_XBMC_TAG:
+                raise MPDError(self, MPDError.ACK_ERROR_ARG,
+                    u'"{}" is not known'.format(arguments[-1]))
+            groups.insert(0, tag)
+            del arguments[-2:]
+
+        return arguments, groups
+
+    def _aggregate(self, filter_list, tagtypes):
+        """
+        Group songs that satisfy the filter rules by MPD tags.
+        Returns dict mapping tuples of tag values to [count, playtime].
+        """
+        tags = [self.MPD_TAG_TO_XBMC_TAG[tagtype] for tagtype in tagtypes]
+        rules, remaining = self._library_rules(filter_list)
+
+        if any(tag not in self.xbmc.resident_tags for tag in tags):
+            songs = self.xbmc.hydrate_all(self._filtered_songs(filter_list))
+        elif remaining:
+            songs = self._filtered_songs(filter_list)
+        else:
+            return self.view.all_songs.group(tags, rules)
+
+        return library.aggregate(songs, tags)
+
+    def _send_groups(self, tagtypes, groups, totals):
+        """
+        Send nested groups, a tag line is sent only when its value differs
+        from the previous group.
+        If totals is true, song count and playtime of each group follow.
+        """
+        previous = ()
+        for key in sorted(groups):
+            lines = []
+            for i, (tagtype, value) in enumerate(itertools.izip(tagtypes, key)):
+                if lines or key[:i + 1] != previous[:i + 1]:
+                    lines.append((tagtype, u'' if value is None else value))
+
+            if totals:
+                count, playtime = groups[key]
+                lines.append(('songs', count))
+                lines.append(('playtime', playtime))
+
+            self._send_lists(lines)
+            previous = key
+
+    def _filter_arguments(self, arguments, operator):
+        """
+        Convert a filter expression in a single argument (MPD 0.21 syntax)
+        to the older list of tag and value arguments. Other arguments are
+        returned unchanged.
+        Only comparisons with the operator of the command (== for exact
+        matching, contains for searching) joined with AND are supported.
+        """
+        if len(arguments) != 1 or not arguments[0].lstrip().startswith(u'('):
+            return arguments
+
+        text = arguments[0].rstrip()
+        tokens = []
+        position = 0
+        while position < len(text):
+            match = self.FILTER_TOKEN.match(text, position)
+            if match is None or match.end() == position:
+                self._filter_error(text)
+            position = match.end()
+
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind in ('double', 'single'):
+                kind = 'string'
+                value = re.sub(ur'\\(.)', ur'\1', value)
+            elif kind == 'word' and value in (u'AND', u'contains'):
+                kind = 'operator' if value == u'contains' else 'and'
+            tokens.append((kind, value))
+
+        result = []
+        if self._parse_filter(text, tokens, 0, operator, result) != len(tokens):
+            self._filter_error(text)
+
+        return result
+
+    def _parse_filter(self, text, tokens, position, operator, result):
+        """
+        Parse a parenthesized expression starting at position, appending
+        tags and values to result. Returns position after the expression.
+        """
+        def expect(kind, value=None):
+            if position >= len(tokens) or tokens[position][0] != kind or \
+                (value is not None and tokens[position][1] != value):
+                self._filter_error(text)
+            return tokens[position][1]
+
+        expect('paren', u'(')
+        position += 1
+
+        if position < len(tokens) and tokens[position] == ('paren', u'('):
+            position = self._parse_filter(text, tokens, position, operator,
+                result)
+            while position < len(tokens) and tokens[position][0] == 'and':
+                position = self._parse_filter(text, tokens, position + 1,
+                    operator, result)
+        else:
+            tag = expect('word')
+            position += 1
+            expect('operator', operator)
+            position += 1
+            value = expect('string')
+            position += 1
+            result.extend([tag, value])
+
+        expect('paren', u')')
+        return position + 1
+
+    def _filter_error(self, text):
+        raise MPDError(self, MPDError.ACK_ERROR_ARG,
+            u'unsupported filter expression: {}'.format(text))
+
     def _make_filter(self, arguments):
         """
         Returns a tuple containing filter dictionary
@@ -641,15 +1337,101 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
 
         return filter_list
 
-    def _filtered_songs(self, filter_list):
+    def _library_rules(self, filter_list):
+        """
+        Split the filter list to (xbmc tag, value) rules that can be
+        evaluated by the library and the remaining rules.
+        """
+        rules = []
+        remaining = []
+        for rule, value in filter_list:
+            if rule in self.MPD_TAG_TO_XBMC_TAG and \
+                self.MPD_TAG_TO_XBMC_TAG[rule] in self.xbmc.resident_tags:
+                rules.append((self.MPD_TAG_TO_XBMC_TAG[rule], value))
+            else:
+                remaining.append((rule, value))
+
+        return rules, remaining
+
+    def _needs_hydration(self, filter_list):
+        """
+        Does evaluating the filter list need tags that are not kept in memory?
+        """
+        for rule, value in filter_list:
+            if rule == 'Any':
+                return not self.xbmc.resident_tags.issuperset(
+                    self.XBMC_TAG_TO_MPD_TAG)
+            if rule in self.MPD_TAG_TO_XBMC_TAG and \
+                self.MPD_TAG_TO_XBMC_TAG[rule] not in self.xbmc.resident_tags:
+                return True
+
+        return False
+
+    def _split_find_args(self, arguments):
+        """
+        Separate the trailing "sort TAG" and "window START:END" arguments of
+        find and search.
+        Returns the remaining arguments, sort as tuple of XBMC tag and
+        reverse flag (or None) and window as tuple (start, end) or None.
+        """
+        arguments = list(arguments)
+        sort = None
+        window = None
+
+        while len(arguments) >= 2 and \
+            arguments[-2].lower() in (u'sort', u'window'):
+            keyword, value = arguments[-2:]
+            del arguments[-2:]
+
+            if keyword.lower() == u'sort':
+                tag = value.lstrip(u'-').capitalize()
+                if tag not in self.MPD_TAG_TO_XBMC_TAG:
+                    raise MPDError(self, MPDError.ACK_ERROR_ARG,
+                        u'invalid sort tag "{}"'.format(value))
+                sort = (self.MPD_TAG_TO_XBMC_TAG[tag], value.startswith(u'-'))
+            else:
+                limits = value.as_range()
+                window = (limits['start'], limits['end'])
+
+        return arguments, sort, window
+
+    def _send_songs(self, songs, window=None):
+        """
+        Send songs (optionally only the (start, end) window of them).
+        """
+        if window is not None:
+            songs = itertools.islice(songs, window[0], window[1])
+
+        for song in self.xbmc.hydrate(songs):
+            self._send_song(song)
+
+    def _filtered_songs(self, filter_list, sort=None):
         """
         Return a list of songs that satisfy the list of filter rules.
+        If sort (XBMC tag, reverse flag) is given, the songs are sorted.
         """
+        if sort is not None and sort[0] not in self.xbmc.resident_tags:
+            return sorted(
+                self.xbmc.hydrate_all(self._filtered_songs(filter_list)),
+                key=lambda song: song[sort[0]], reverse=sort[1])
+
+        rules, remaining = self._library_rules(filter_list)
+
+        if sort is None:
+            songs = self.view.all_songs.select(rules)
+        else:
+            songs = self.view.all_songs.select(rules, *sort)
+
+        if not remaining:
+            return songs
+
+        if self._needs_hydration(remaining):
+            songs = self.xbmc.hydrate_all(songs)
 
         def predicate(song):
-            return self._filter_predicate(filter_list, operator.eq, song)
+            return self._filter_predicate(remaining, operator.eq, song)
 
-        return itertools.ifilter(predicate, self.xbmc.all_songs.value)
+        return itertools.ifilter(predicate, songs)
 
     def _filter_predicate(self, filter_list, compare, song):
         """
@@ -658,7 +1440,7 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         match = True
         for rule, value in filter_list:
             if rule == 'File' or rule == 'Filename':
-                match &= (compare(value, self._xbmc_path_to_mpd_path(song['file'])))
+                match &= (compare(value, song.path))
             elif rule == 'Any':
                 tmpmatch = False
                 for xbmctag in self.MPD_TAG_TO_XBMC_TAG.values():
@@ -674,32 +1456,50 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         Find command.
         """
         # find album "Café del Mar, volumen seis" artist "A New Funky Generation"
+        # find artist "Bob Marley" sort -Date window 0:20
+        # find "((artist == 'Bob Marley') AND (album == 'Legend'))"
+
+        arguments, sort, window = self._split_find_args(command.args)
+        arguments = self._filter_arguments(arguments, u'==')
 
-        if len(command.args) < 2:
+        if len(arguments) < 2:
             raise command.arg_count_exception()
 
-        filter_list = self._make_filter(command.args)
+        filter_list = self._make_filter(arguments)
 
-        for song in self._filtered_songs(filter_list):
-                self._send_song(song)
+        self._send_songs(self._filtered_songs(filter_list, sort), window)
 
     def count(self, command):
         """
         Count command.
         """
         # count album "Café del Mar, volumen seis" artist "A New Funky Generation"
+        # count genre "Rock" group artist
+
+        arguments, groups = self._split_group_args(command.args)
+        arguments = self._filter_arguments(arguments, u'==')
 
-        if len(command.args) < 2:
+        if len(arguments) < 2 and not (groups and not arguments):
             raise command.arg_count_exception()
 
-        filter_list = self._make_filter(command.args)
+        filter_list = self._make_filter(arguments)
 
-        count = 0
-        playtime = 0
+        if groups:
+            self._send_groups(groups,
+                self._aggregate(filter_list, groups), True)
+            return
 
-        for song in self._filtered_songs(filter_list):
-            count += 1
-            playtime += song['duration']
+        rules, remaining = self._library_rules(filter_list)
+
+        if remaining:
+            count = 0
+            playtime = 0
+
+            for song in self._filtered_songs(filter_list):
+                count += 1
+                playtime += song['duration']
+        else:
+            count, playtime = self.view.all_songs.count(rules)
 
         self._send_lists([
             ('songs', count),
@@ -710,18 +1510,27 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         Search command.
         """
         # like find, but case insensitive and uses substring instead of equality
+        # search "(title contains 'love')"
+
+        arguments, sort, window = self._split_find_args(command.args)
+        arguments = self._filter_arguments(arguments, u'contains')
 
-        if len(command.args) < 2:
+        if len(arguments) < 2:
             raise command.arg_count_exception()
 
-        filter_list = self._make_filter(command.args)
+        filter_list = self._make_filter(arguments)
 
         def contains_lcase(a, b):
             return a.lower() in b.lower()
 
-        for song in self.xbmc.all_songs.value:
-            if self._filter_predicate(filter_list, contains_lcase, song):
-                self._send_song(song)
+        songs = self._filtered_songs([], sort)
+        if self._needs_hydration(filter_list):
+            songs = self.xbmc.hydrate_all(songs)
+
+        matching = (song for song in songs
+            if self._filter_predicate(filter_list, contains_lcase, song))
+
+        self._send_songs(matching, window)
 
     def currentsong(self, command):
         """
@@ -729,12 +1538,13 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         """
         command.check_arg_count(0)
 
-        playlist = self.xbmc.playlist.value
+        playlist = self.view.playlist
 
-        if self.xbmc.state.value is None:
+        # The view has no current song if it is not in its playlist.
+        if self.view.state is None or self.view.state['current'] is None:
             return
 
-        current = self.xbmc.state.value['current']
+        current = self.view.state['current']
         self._send_song(playlist[current], current, current)
 
     def lsinfo(self, command):
@@ -747,22 +1557,25 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
             path = command.args[0]
         else:
             path = ''
-        path = self._mpd_path_to_xbmc_path(path)
 
-        filelist, dirlist, pllist = self.xbmc.get_directory(path)
+        song = self.view.all_songs.by_path.get(path)
+        if song is not None:
+            for song in self.xbmc.hydrate([song]):
+                self._send_song(song)
+            return
+
+        filelist, dirlist, pllist = \
+            self.xbmc.get_directory(self._mpd_path_to_xbmc_path(path))
 
         for d in dirlist:
-            self._send_lists([('directory',
-                self._xbmc_path_to_mpd_path(d['file']))])
+            self._send_lists([('directory', d.path)])
         for f in filelist:
             self._send_song(f)
         for pl in pllist:
-            self._send_lists([('playlist',
-                self._xbmc_path_to_mpd_path(pl['file']))])
+            self._send_lists([('playlist', pl.path)])
 
-        if path.strip('/') == '':
-            for pl in self.xbmc.list_playlists():
-                self._send_lists(['playlist', pl['label']])
+        if path.strip('/') == '' and self.playlists is not None:
+            self._send_stored_playlists()
 
     def listall(self, command):
         """
@@ -774,12 +1587,12 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
             path = command.args[0]
         else:
             path = ''
-        path = self._mpd_path_to_xbmc_path(path)
 
         def file_fun(f):
-            self._send_path('file', f['file'])
+            self._send_lists([('file', f.path)])
 
-        self._walk_xbmc_files(file_fun, path)
+        self._walk_xbmc_files(file_fun,
+            library.Entry(self._mpd_path_to_xbmc_path(path), path))
 
     def listallinfo(self, command):
         """
@@ -791,44 +1604,53 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
             path = command.args[0]
         else:
             path = ''
-        path = self._mpd_path_to_xbmc_path(path)
 
         def file_fun(f):
             self._send_song(f)
 
-        self._walk_xbmc_files(file_fun, path)
+        self._walk_xbmc_files(file_fun,
+            library.Entry(self._mpd_path_to_xbmc_path(path), path))
 
-    def _walk_xbmc_files(self, file_fun, xbmc_path):
+    def _walk_xbmc_files(self, file_fun, directory):
         """
         Walking the XBMC directory structure.
+        directory is a library.Entry.
         """
 
-        self._send_path('directory', xbmc_path)
+        self._send_lists([('directory', directory.path)])
 
-        filelist, dirlist, pllist = self.xbmc.get_directory(xbmc_path)
+        filelist, dirlist, pllist = self.xbmc.get_directory(directory.file)
 
         for d in dirlist:
-           self._walk_xbmc_files(file_fun, d['file'])
+           self._walk_xbmc_files(file_fun, d)
 
         for f in filelist:
             file_fun(f)
         
         for p in pllist:
-            self._send_path('playlist', p['file'])
+            self._send_lists([('playlist', p.path)])
 
     def close(self, command):
         command.check_arg_count(0)
-        self.transport.loseConnection()
+        twisted.internet.reactor.callFromThread(self.transport.loseConnection)
+
+    # Change notifications come from the XBMC update thread,
+    # the responses are sent from the reactor thread.
 
     def _state_changed(self):
-        self._noidle('player')
+        twisted.internet.reactor.callFromThread(self._changed, 'player')
 
     def _playlist_changed(self):
-        self.playlist_id += 1
-        self._noidle('playlist')
+        twisted.internet.reactor.callFromThread(self._changed, 'playlist')
             
     def _volume_changed(self):
-        self._noidle('mixer')
+        twisted.internet.reactor.callFromThread(self._changed, 'mixer')
+
+    def _database_changed(self):
+        twisted.internet.reactor.callFromThread(self._changed, 'database')
+
+    def _stored_playlist_changed(self):
+        twisted.internet.reactor.callFromThread(self._changed, 'stored_playlist')
             
     def shuffle(self, command):
         """
@@ -837,6 +1659,6 @@ class MPD(twisted.protocols.basic.LineOnlyReceiver):
         command.check_arg_count(0, 1)
 
         if len(command.args) > 0:
-            raise MPDError(self, MPDError.ACK_ERROR_SYSTEM, u'Range argument is not implemented.')))
+            raise MPDError(self, MPDError.ACK_ERROR_SYSTEM, u'Range argument is not implemented.')
         
         self.xbmc.shuffle()
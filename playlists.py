@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of xbmcpd.
+
+# xbmcpd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# xbmcpd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with xbmcpd.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import observer
+
+
+class PlaylistStore(object):
+    """
+    Stored playlists kept as m3u files with MPD paths in a directory.
+    Parsed playlists are cached and read again only when their file changes.
+    """
+
+    SUFFIX = '.m3u'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.changed = observer.Observable()
+
+        # name -> (modification time, tuple of paths)
+        self._cache = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _file(self, name):
+        """
+        Return file name of the playlist, raise ValueError for invalid names.
+        """
+        if not name or name.startswith(u'.') or \
+            u'/' in name or u'\n' in name or u'\r' in name:
+            raise ValueError(u'invalid playlist name "{}"'.format(name))
+
+        return os.path.join(self.directory, name.encode('utf8') + self.SUFFIX)
+
+    def list(self):
+        """
+        Return list of (name, modification time) pairs sorted by name.
+        """
+        result = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith('.') or not filename.endswith(self.SUFFIX):
+                continue
+
+            mtime = os.path.getmtime(os.path.join(self.directory, filename))
+            result.append(
+                (filename[:-len(self.SUFFIX)].decode('utf8', 'replace'), mtime))
+
+        result.sort()
+        return result
+
+    def exists(self, name):
+        return os.path.exists(self._file(name))
+
+    def get(self, name):
+        """
+        Return tuple of MPD paths in the playlist.
+        Raises KeyError if the playlist doesn't exist.
+        """
+        filename = self._file(name)
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            raise KeyError(name)
+
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with open(filename, 'rb') as f:
+            paths = tuple(line.rstrip('\r\n').decode('utf8', 'replace')
+                for line in f if line.strip() and not line.startswith('#'))
+
+        self._cache[name] = (mtime, paths)
+        return paths
+
+    def save(self, name, paths):
+        """
+        Write the playlist, replacing it if it exists.
+        """
+        filename = self._file(name)
+        temp_filename = filename + '.tmp'
+
+        with open(temp_filename, 'wb') as f:
+            for path in paths:
+                f.write(path.encode('utf8') + '\n')
+        os.rename(temp_filename, filename)
+
+        self._cache.pop(name, None)
+        self.changed()
+
+    def remove(self, name):
+        """
+        Remove the playlist, raises KeyError if it doesn't exist.
+        """
+        try:
+            os.remove(self._file(name))
+        except OSError:
+            raise KeyError(name)
+
+        self._cache.pop(name, None)
+        self.changed()
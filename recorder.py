@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of xbmcpd.
+
+# xbmcpd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# xbmcpd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with xbmcpd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Recording of client sessions and XBMC requests, for replay.py.
+
+The recording is a file of JSON objects, one per line, each with
+the 'event' type and 'time' (seconds since epoch):
+    start         xbmcpd started, with 'musicpath' and 'pathsep'
+    connected     client 'connection' connected
+    command       line received from client 'connection'
+    disconnected  client 'connection' disconnected
+    rpc           XBMC 'method' called with 'params', returned 'result'
+                  or 'error' (with 'code' and 'message') after 'duration'
+"""
+
+import os
+import time
+import json
+import itertools
+import threading
+
+
+class Recorder(object):
+    """
+    Appends events to the recording file.
+    Can be shared by threads and by forked processes.
+    """
+
+    def __init__(self, path, musicpath, path_sep):
+        self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+        self._connections = itertools.count()
+
+        self._write('start', musicpath=musicpath, pathsep=path_sep)
+
+    def _write(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        line = json.dumps(fields, sort_keys=True) + '\n'
+
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def connection(self):
+        """
+        Return identifier for a new client connection.
+        """
+        return u'{}-{}'.format(os.getpid(), next(self._connections))
+
+    def connected(self, connection):
+        self._write('connected', connection=connection)
+
+    def disconnected(self, connection):
+        self._write('disconnected', connection=connection)
+
+    def command(self, connection, line):
+        self._write('command', connection=connection, line=line)
+
+    def rpc(self, method, params, duration, result=None, error=None):
+        """
+        Record an XBMC request, error is None or a dictionary with
+        'code' and 'message'.
+        """
+        if error is None:
+            self._write('rpc', method=method, params=params,
+                duration=duration, result=result)
+        else:
+            self._write('rpc', method=method, params=params,
+                duration=duration, error=error)
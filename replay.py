@@ -0,0 +1,390 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of xbmcpd.
+
+# xbmcpd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# xbmcpd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with xbmcpd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Replays a recording made with xbmcpd.py --record as a benchmark.
+
+Starts a stand-in XBMC that answers with the recorded responses, starts
+a fresh xbmcpd using it and sends the recorded client sessions to it.
+Prints latency of the commands and the throughput.
+"""
+
+import os
+import sys
+import time
+import math
+import json
+import socket
+import argparse
+import threading
+import subprocess
+import collections
+import BaseHTTPServer
+import SocketServer
+
+
+def _key(method, params):
+    return (method, json.dumps(params, sort_keys=True))
+
+
+class Responses(object):
+    """
+    Recorded XBMC responses.
+    Repeated requests get the recorded responses in order, the last one
+    is repeated when they run out. Requests that were not recorded with
+    the same parameters get the last response of the method.
+    """
+
+    def __init__(self):
+        self._responses = collections.defaultdict(list)
+        self._positions = collections.defaultdict(int)
+        self._by_method = {}
+        self._lock = threading.Lock()
+
+    def add(self, method, params, response):
+        self._responses[_key(method, params)].append(response)
+        self._by_method[method] = response
+
+    def get(self, method, params):
+        """
+        Return dictionary with 'result' or 'error' for the request.
+        """
+        key = _key(method, params)
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                return self._by_method.get(method, {'error':
+                    {'code': -32601, 'message': 'Method not found.'}})
+
+            position = self._positions[key]
+            if position < len(responses) - 1:
+                self._positions[key] = position + 1
+            return responses[position]
+
+
+class Recording(object):
+    """
+    Recording loaded from a file.
+    sessions is a list of (connection, time of connecting,
+    list of (time, line)).
+    """
+
+    def __init__(self, path):
+        self.musicpath = None
+        self.pathsep = '/'
+        self.responses = Responses()
+
+        sessions = collections.OrderedDict()
+        with open(path, 'rb') as f:
+            for line in f:
+                event = json.loads(line)
+                kind = event['event']
+
+                if kind == 'start':
+                    if self.musicpath is None:
+                        self.musicpath = event['musicpath']
+                        self.pathsep = event['pathsep']
+                elif kind == 'connected':
+                    sessions[event['connection']] = (event['time'], [])
+                elif kind == 'command':
+                    session = sessions.setdefault(
+                        event['connection'], (event['time'], []))
+                    session[1].append((event['time'], event['line']))
+                elif kind == 'rpc':
+                    if 'error' in event:
+                        response = {'error': event['error']}
+                    else:
+                        response = {'result': event['result']}
+                    self.responses.add(
+                        event['method'], event['params'], response)
+
+        self.sessions = [(connection, start, commands)
+            for connection, (start, commands) in sessions.items() if commands]
+
+
+class FakeXBMCHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers JSON-RPC requests (including batches) from the responses
+    of the server.
+    """
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(
+            int(self.headers.getheader('content-length'))))
+
+        if isinstance(request, list):
+            response = [self._answer(item) for item in request]
+        else:
+            response = self._answer(request)
+
+        body = json.dumps(response)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # Downloads (album art) are not recorded.
+        self.send_error(404)
+
+    def _answer(self, request):
+        response = dict(self.server.responses.get(
+            request['method'], request.get('params', {})))
+        response['jsonrpc'] = '2.0'
+        response['id'] = request.get('id')
+        return response
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeXBMC(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Stand-in XBMC serving recorded responses on a free local port.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, responses):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+            FakeXBMCHandler)
+        self.responses = responses
+
+    def url(self):
+        return 'http://127.0.0.1:{}/jsonrpc'.format(self.server_address[1])
+
+
+class Session(threading.Thread):
+    """
+    Sends commands of one recorded connection and measures the time until
+    each response is complete.
+    """
+
+    def __init__(self, port, connected, commands, clock, latencies):
+        """
+        connected is the recorded time of the connection and clock
+        a function converting recorded times to times of the replay,
+        or None to send commands as fast as possible.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._port = port
+        self._connected = connected
+        self._commands = commands
+        self._clock = clock
+        self._latencies = latencies
+        self.error = None
+
+    def _wait(self, recorded_time):
+        if self._clock is not None:
+            delay = self._clock(recorded_time) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def run(self):
+        try:
+            self._run()
+        except (IOError, socket.error) as e:
+            self.error = e
+
+    def _run(self):
+        self._wait(self._connected)
+        sock = socket.create_connection(('127.0.0.1', self._port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = sock.makefile('rb')
+        self._reader.readline() # greeting
+
+        in_list = False
+        idle = False
+
+        for recorded_time, line in self._commands:
+            self._wait(recorded_time)
+
+            name = line.split(' ', 1)[0].lower()
+
+            if idle and name != 'noidle':
+                # idle returned on its own when the session was recorded.
+                sock.sendall('noidle\n')
+                self._read_response()
+                idle = False
+
+            sent = time.time()
+            sock.sendall(line.encode('utf8') + '\n')
+
+            if name in ('command_list_begin', 'command_list_ok_begin'):
+                in_list = True
+                continue
+            elif in_list and name != 'command_list_end':
+                continue
+            elif name == 'idle':
+                idle = True
+                continue
+            elif name == 'close':
+                break
+
+            ok = self._read_response()
+
+            if in_list:
+                in_list = False
+                self._latencies.append(('command_list', time.time() - sent, ok))
+            elif name == 'noidle':
+                idle = False
+            else:
+                self._latencies.append((name, time.time() - sent, ok))
+
+        sock.close()
+
+    def _read_response(self):
+        """
+        Read a response, return False if it is an error.
+        """
+        while True:
+            line = self._reader.readline()
+            if not line:
+                raise IOError('connection closed by xbmcpd')
+
+            if line == 'OK\n':
+                return True
+            elif line.startswith('ACK '):
+                return False
+            elif line.startswith('binary: '):
+                self._reader.read(int(line[len('binary: '):]) + 1)
+
+
+def wait_for_port(port, process, timeout):
+    """
+    Wait until xbmcpd accepts connections.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('xbmcpd exited with status {}'.format(
+                process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+
+    raise RuntimeError('xbmcpd did not start')
+
+
+def percentile(values, fraction):
+    """
+    Return the nearest rank percentile of sorted values.
+    """
+    return values[max(0, int(math.ceil(len(values) * fraction)) - 1)]
+
+
+def report(latencies, duration):
+    """
+    Print latency statistics by command and the throughput.
+    """
+    by_command = collections.defaultdict(list)
+    errors = collections.Counter()
+    for name, latency, ok in latencies:
+        by_command[name].append(latency)
+        if not ok:
+            errors[name] += 1
+
+    print '{:<24} {:>7} {:>6} {:>9} {:>9} {:>9} {:>9}'.format(
+        'command', 'count', 'errors', 'mean ms', 'p50 ms', 'p95 ms', 'max ms')
+    for name in sorted(by_command):
+        values = sorted(by_command[name])
+        print '{:<24} {:>7} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            name, len(values), errors[name],
+            1000 * sum(values) / len(values),
+            1000 * percentile(values, 0.5), 1000 * percentile(values, 0.95),
+            1000 * values[-1])
+
+    print
+    print '{} commands in {:.2f} s, {:.1f} commands/s'.format(
+        len(latencies), duration, len(latencies) / duration if duration else 0)
+
+
+arg_parser = argparse.ArgumentParser(description=__doc__.strip(),
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+arg_parser.add_argument('recording',
+    help="file written by xbmcpd.py --record")
+arg_parser.add_argument('--speed', default=1.0, type=float,
+    help="replay speed relative to the recording, 0 sends every command "
+        "right after the previous response (default: %(default)s)")
+arg_parser.add_argument('--port', default=6650, type=int,
+    help="port for the xbmcpd being tested (default: %(default)s)")
+arg_parser.add_argument('--start-timeout', default=60, type=float,
+    metavar='SECONDS',
+    help="time to wait for xbmcpd to start (default: %(default)s)")
+arg_parser.add_argument('xbmcpd_arguments', nargs=argparse.REMAINDER,
+    help="more arguments for xbmcpd, after --")
+
+if __name__ == '__main__':
+    arguments = arg_parser.parse_args()
+
+    recording = Recording(arguments.recording)
+    if recording.musicpath is None:
+        arg_parser.error('no start of xbmcpd in the recording')
+
+    xbmc_server = FakeXBMC(recording.responses)
+    server_thread = threading.Thread(target=xbmc_server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    extra_arguments = arguments.xbmcpd_arguments
+    if extra_arguments[:1] == ['--']:
+        extra_arguments = extra_arguments[1:]
+
+    process = subprocess.Popen([sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xbmcpd.py'),
+        '--url', xbmc_server.url(), '--port', str(arguments.port),
+        '--musicpath', recording.musicpath, '--pathsep', recording.pathsep] +
+        extra_arguments)
+
+    try:
+        wait_for_port(arguments.port, process, arguments.start_timeout)
+
+        latencies = []
+        start = time.time()
+
+        if arguments.speed and recording.sessions:
+            first = min(connected for c, connected, l in recording.sessions)
+            clock = lambda recorded_time: \
+                start + (recorded_time - first) / arguments.speed
+        else:
+            clock = None
+
+        sessions = [Session(arguments.port, connected, commands, clock,
+                latencies)
+            for connection, connected, commands in recording.sessions]
+
+        for session in sessions:
+            session.start()
+        for session in sessions:
+            session.join()
+
+        duration = time.time() - start
+
+        for session in sessions:
+            if session.error is not None:
+                print >>sys.stderr, 'session failed: {}'.format(session.error)
+
+        report(latencies, duration)
+    finally:
+        process.terminate()
+        process.wait()
+        xbmc_server.shutdown()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of xbmcpd.
+
+# xbmcpd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# xbmcpd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with xbmcpd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests of the library snapshots.
+
+Run with python -m unittest test_library
+"""
+
+import pickle
+import random
+import unittest
+
+import library
+
+
+def make_song(number, version=0):
+    return library.Song(u'/music/{}.mp3'.format(number), u'{}.mp3'.format(number),
+        u'Title {}'.format(number % 7 + version), u'Artist {}'.format(number % 5),
+        u'Album {}'.format(number % 11), number % 13, u'Genre {}'.format(version),
+        1990 + number % 3, 100 + number % 17)
+
+
+class LibraryUpdateTestCase(unittest.TestCase):
+
+    TAGS = ('title', 'artist', 'album', 'track', 'year', 'duration')
+
+    def update(self, previous, songs):
+        """
+        Update the library like XBMCControl._update_library.
+        """
+        runs = []
+        added = []
+        removed = []
+        seen = set()
+        for i, song in enumerate(songs):
+            position = previous.file_position(song.file)
+            if position is not None:
+                seen.add(position)
+                old = previous.songs[position]
+                if old is song:
+                    if runs and runs[-1][0] + runs[-1][2] == i and \
+                        runs[-1][1] + runs[-1][2] == position:
+                        runs[-1][2] += 1
+                    else:
+                        runs.append([i, position, 1])
+                    continue
+                removed.append(old)
+            added.append(song)
+        removed.extend(song for i, song in enumerate(previous.songs)
+            if i not in seen)
+
+        return previous.updated(songs, runs, added, removed)
+
+    def assertSameLibrary(self, updated, songs):
+        built = library.Library(songs, True)
+
+        self.assertEqual(updated.songs, built.songs)
+        for song in songs:
+            self.assertEqual(updated.by_path.get(song.path), song)
+            self.assertEqual(updated.file_position(song.file),
+                built.file_position(song.file))
+        self.assertIsNone(updated.by_path.get(u'missing.mp3'))
+
+        for tag in self.TAGS:
+            self.assertEqual(list(updated.order(tag)), list(built.order(tag)))
+            self.assertEqual(updated.tag_values(tag, []),
+                built.tag_values(tag, []))
+            for value in built.tag_values(tag, []):
+                rules = [(tag, unicode(value))]
+                self.assertEqual(list(updated.select(rules)),
+                    list(built.select(rules)))
+
+    def test_updates(self):
+        generator = random.Random(1)
+        songs = [make_song(i) for i in range(200)]
+        current = library.Library(songs, True)
+        for tag in self.TAGS:
+            current.order(tag)
+        next_number = len(songs)
+
+        for step in range(30):
+            songs = list(songs)
+            for change in range(generator.randint(1, 8)):
+                kind = generator.choice(['add', 'remove', 'modify'])
+                position = generator.randrange(len(songs))
+                if kind == 'add':
+                    songs.insert(position, make_song(next_number))
+                    next_number += 1
+                elif kind == 'remove':
+                    del songs[position]
+                else:
+                    number = int(songs[position].path.split('.')[0])
+                    songs[position] = make_song(number, step + 1)
+
+            current = self.update(current, songs)
+            self.assertSameLibrary(current, songs)
+
+    def test_reordered(self):
+        songs = [make_song(i) for i in range(20)]
+        current = library.Library(songs, True)
+        songs.reverse()
+        self.assertSameLibrary(self.update(current, songs), songs)
+
+    def test_pickled_overlay(self):
+        songs = [make_song(i) for i in range(100)]
+        current = library.Library(songs, True)
+        songs = songs[:50] + songs[51:] + [make_song(100)]
+        current = pickle.loads(pickle.dumps(self.update(current, songs),
+            pickle.HIGHEST_PROTOCOL))
+        self.assertSameLibrary(current, songs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of xbmcpd.
+
+# xbmcpd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# xbmcpd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with xbmcpd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests of the requests sent to XBMC, against the stand-in XBMC of replay.py.
+
+Run with python -m unittest test_xbmc
+"""
+
+import threading
+import unittest
+
+import xbmc
+import replay
+
+
+class XBMCTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.responses = replay.Responses()
+        # XBMC without songs, nothing playing.
+        for method, result in [
+                ('JSONRPC.Version', {'version': 3}),
+                ('AudioPlaylist.State', None),
+                ('AudioLibrary.GetSongs', {'songs': [], 'limits': {'total': 0}}),
+                ('AudioPlaylist.GetItems', {'items': []}),
+                ('XBMC.GetVolume', 50)]:
+            self.responses.add(method, {}, {'result': result})
+
+        self.server = replay.FakeXBMC(self.responses)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.xbmc = xbmc.XBMCControl(self.server.url(), u'/music')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_call(self):
+        self.responses.add('AudioPlayer.GetTime', {}, {'result': {'time': 1}})
+        self.assertEqual(self.xbmc.call.AudioPlayer.GetTime(), {'time': 1})
+
+    def test_call_error(self):
+        self.responses.add('AudioPlaylist.Remove', {'item': 5},
+            {'error': {'code': -32602, 'message': u'Invalid params.'}})
+        with self.assertRaises(xbmc.RPCError) as context:
+            self.xbmc.call.AudioPlaylist.Remove(item=5)
+        self.assertEqual(context.exception.code, -32602)
+
+    def test_batch(self):
+        self.responses.add('AudioPlaylist.Add',
+            {'item': {'file': u'/music/a.mp3'}}, {'result': u'OK'})
+        self.responses.add('AudioPlaylist.Remove', {'item': 7},
+            {'error': {'code': -32602, 'message': u'Invalid params.'}})
+
+        self.assertEqual(self.xbmc.batch([
+                ('AudioPlaylist.Add', {'item': {'file': u'/music/a.mp3'}}),
+                ('AudioPlaylist.Remove', {'item': 7})]),
+            [(u'OK', None),
+             (None, {'code': -32602, 'message': u'Invalid params.'})])
+
+    def test_batch_unavailable(self):
+        # Nothing listens on port 1.
+        self.xbmc._url = 'http://127.0.0.1:1/jsonrpc'
+        with self.assertRaises(xbmc.XBMCUnavailable):
+            self.xbmc.batch([('AudioPlaylist.Clear', {})])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of xbmcpd.
+
+# xbmcpd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# xbmcpd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with xbmcpd.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import signal
+import socket
+import threading
+import functools
+import itertools
+import logging
+import cPickle as pickle
+
+# Variables of XBMCControl whose values are sent from the coordinator
+# to the workers.
+SHARED_VARIABLES = ('state', 'all_songs', 'playlist', 'volume')
+
+
+def listen_socket(port, backlog=50):
+    """
+    Return a listening TCP socket that shares the port with sockets
+    of the other workers.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def _spawn(name, func, *args):
+    thread = threading.Thread(target=func, args=args, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _picklable(exception):
+    """
+    Return the exception if it survives pickling, otherwise a RuntimeError
+    with its text.
+    """
+    try:
+        pickle.loads(pickle.dumps(exception, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return RuntimeError(unicode(exception))
+    return exception
+
+
+class Channel(object):
+    """
+    Pickled messages sent over one end of a socket pair.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._reader = sock.makefile('rb')
+        self._writer = sock.makefile('wb')
+        self._lock = threading.Lock()
+
+    def send(self, *message):
+        self.send_pickled(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+
+    def send_pickled(self, data):
+        """
+        Send a message that was already pickled.
+        """
+        with self._lock:
+            self._writer.write(data)
+            self._writer.flush()
+
+    def receive(self):
+        """
+        Return the next message (tuple) or None if the other side is closed.
+        """
+        try:
+            return pickle.load(self._reader)
+        except EOFError:
+            return None
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+        self._sock.close()
+
+
+class Coordinator(object):
+    """
+    Polls XBMC in the main process and sends new values of the shared
+    variables to the worker processes serving the clients.
+    """
+
+    def __init__(self, xbmc):
+        self.xbmc = xbmc
+        self._channels = []
+        self._pids = []
+
+        # Names of variables that changed since they were last sent.
+        self._pending = set()
+        self._pending_condition = threading.Condition()
+
+        self._subscriptions = []
+        for name in SHARED_VARIABLES:
+            func = functools.partial(self._changed, name)
+            getattr(xbmc, name).changed.subscribe(func)
+            self._subscriptions.append((name, func))
+
+    def fork_worker(self, run):
+        """
+        Fork a worker process that calls run(worker) and exits.
+        Must be called before the coordinator is started, while the process
+        has no other threads.
+        """
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+
+        if pid == 0:
+            parent_sock.close()
+            for channel in self._channels:
+                channel.close()
+            for name, func in self._subscriptions:
+                getattr(self.xbmc, name).changed.unsubscribe(func)
+
+            status = 0
+            try:
+                run(Worker(self.xbmc, Channel(child_sock)))
+            except:
+                logging.critical(u'Worker failed!', exc_info=True)
+                status = 1
+            os._exit(status)
+
+        child_sock.close()
+        self._channels.append(Channel(parent_sock))
+        self._pids.append(pid)
+        logging.info(u'started worker {}'.format(pid))
+
+        return pid
+
+    def _changed(self, name):
+        with self._pending_condition:
+            self._pending.add(name)
+            self._pending_condition.notify()
+
+    def _message(self, name):
+        """
+        Return pickled message with the current value of a variable
+        and its version.
+        """
+        snapshot = getattr(self.xbmc, name).snapshot
+        return pickle.dumps(('value', name, snapshot.version, snapshot.value),
+            pickle.HIGHEST_PROTOCOL)
+
+    def _publish(self):
+        """
+        Send the changed variables to all workers.
+        Each value is pickled once and changes that come while sending are
+        merged.
+        """
+        while True:
+            with self._pending_condition:
+                while not self._pending:
+                    self._pending_condition.wait()
+                names = list(self._pending)
+                self._pending.clear()
+
+            for name in names:
+                data = self._message(name)
+                for channel in self._channels:
+                    try:
+                        channel.send_pickled(data)
+                    except socket.error:
+                        logging.warning(
+                            u'sending {} to a worker failed'.format(name))
+
+    def _serve_requests(self, channel):
+        """
+        Handle messages from a worker:
+        ('update', name, force, request id) recalculates a variable and
+        replies with its value or the exception,
+        ('set', name, value) sets a variable edited by the worker, the new
+        value is then published to all workers.
+        """
+        while True:
+            message = channel.receive()
+            if message is None:
+                return
+
+            if message[0] == 'set':
+                kind, name, value = message
+                getattr(self.xbmc, name).value = value
+                continue
+
+            kind, name, force, request = message
+            try:
+                getattr(self.xbmc, name).update(force)
+            except Exception as e:
+                channel.send('failed', request, _picklable(e))
+            else:
+                # The value goes before the reply, so that the worker has
+                # it when the request returns.
+                channel.send_pickled(self._message(name))
+                channel.send('done', request)
+
+    def run(self):
+        """
+        Start polling XBMC and wait until all workers exit.
+        """
+        for channel in self._channels:
+            _spawn('worker requests', self._serve_requests, channel)
+        _spawn('publisher', self._publish)
+
+        # Only the workers serve clients and warm up their caches.
+        self.xbmc.start(warm_up=False)
+
+        while self._pids:
+            try:
+                pid, status = os.wait()
+            except KeyboardInterrupt:
+                for pid in self._pids:
+                    os.kill(pid, signal.SIGTERM)
+                continue
+
+            self._pids.remove(pid)
+            logging.info(u'worker {} exited with status {}'.format(pid, status))
+
+
+class Worker(object):
+    """
+    Keeps the shared variables of a forked process up to date with the
+    coordinator.
+
+    Variables are never recalculated in the worker, their update method is
+    replaced by a request to the coordinator that waits for the new value.
+    Values edited locally (after editing the playlist for example) are sent
+    to the coordinator, which publishes them to all workers.
+    """
+
+    def __init__(self, xbmc, channel):
+        self.xbmc = xbmc
+        self._channel = channel
+        self._receiving = threading.local()
+
+        # Version of the last value received from the coordinator, by name.
+        self._versions = {}
+
+        # Request id -> [event, exception or None]
+        self._requests = {}
+        self._request_ids = itertools.count()
+        self._lock = threading.Lock()
+
+        for name in SHARED_VARIABLES:
+            var = getattr(xbmc, name)
+            var.changed.subscribe(functools.partial(self._changed, name))
+            var.update = functools.partial(self._request, name)
+
+        _spawn('coordinator updates', self._receive)
+        xbmc.start_warm_up()
+
+    def _request(self, name, force=False):
+        """
+        Let the coordinator recalculate the variable and wait until
+        the value arrives. Exceptions of the recalculation are raised here.
+        """
+        if not force and getattr(self.xbmc, name)._time_remaining() > 0:
+            return
+
+        pending = [threading.Event(), None]
+        with self._lock:
+            request = next(self._request_ids)
+            self._requests[request] = pending
+
+        self._channel.send('update', name, force, request)
+
+        pending[0].wait()
+        if pending[1] is not None:
+            raise pending[1]
+
+    def _changed(self, name):
+        if not getattr(self._receiving, 'active', False):
+            self._channel.send('set', name, getattr(self.xbmc, name).value)
+
+    def _receive(self):
+        self._receiving.active = True
+
+        while True:
+            message = self._channel.receive()
+            if message is None:
+                logging.critical(u'Coordinator exited, stopping worker.')
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+
+            if message[0] == 'value':
+                kind, name, version, value = message
+                # A value published before a reply may come after it.
+                if version > self._versions.get(name, 0):
+                    self._versions[name] = version
+                    getattr(self.xbmc, name).value = value
+                continue
+
+            with self._lock:
+                pending = self._requests.pop(message[1])
+            if message[0] == 'failed':
+                pending[1] = message[2]
+            pending[0].set()
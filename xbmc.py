@@ -16,53 +16,409 @@
 # You should have received a copy of the GNU General Public License
 # along with xbmcpd.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 import time
+import collections
+import contextlib
 import threading
 import logging
+import itertools
+import json
+import urllib
+import urllib2
+import urlparse
+import httplib
 
-import jsonrpc.proxy
+import jsonrpc.common
 
 import observer
+import library
+import libraryfile
+import art
 
 from pprint import pprint
 
-class TimedVar:
+class SingleFlight(object):
+    """
+    Runs at most one call for each key at a time.
+    Callers that arrive while a call with the same key is running wait for
+    it to finish and get its result (or exception) instead of calling again.
+    """
+
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.exc_info = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def call(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class Scheduler(object):
+    """
+    Limits the number of requests running in XBMC at the same time.
+    Waiting interactive requests are started before the background ones
+    and background requests never take the last free slot, so user
+    commands don't wait behind a long library download.
+    """
+
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+    def __init__(self, slots=2):
+        self._slots = slots
+        self._running = [0, 0]
+        self._waiting = [0, 0]
+        self._condition = threading.Condition()
+        self._local = threading.local()
+
+    def priority(self):
+        """
+        Return priority of requests made by the current thread.
+        """
+        return getattr(self._local, 'priority', self.INTERACTIVE)
+
+    @contextlib.contextmanager
+    def background(self):
+        """
+        Requests made by the current thread inside this context have
+        background priority.
+        """
+        previous = self.priority()
+        self._local.priority = self.BACKGROUND
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def _can_start(self, priority):
+        running = sum(self._running)
+        if priority == self.INTERACTIVE:
+            return running < self._slots
+        else:
+            return self._waiting[self.INTERACTIVE] == 0 and \
+                running < max(self._slots - 1, 1)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Wait for a free slot and call func.
+        """
+        priority = self.priority()
+
+        with self._condition:
+            self._waiting[priority] += 1
+            while not self._can_start(priority):
+                self._condition.wait()
+            self._waiting[priority] -= 1
+            self._running[priority] += 1
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._condition:
+                self._running[priority] -= 1
+                self._condition.notify_all()
+
+
+class XBMCUnavailable(Exception):
+    """
+    XBMC didn't respond in time, or it failed recently and requests
+    are not sent.
+    """
+
+
+class CircuitOpen(XBMCUnavailable):
+    pass
+
+
+class TooManySongs(Exception):
+    """
+    A command would need to load tags of too many songs from XBMC.
+    """
+
+    def __init__(self, count, limit):
+        Exception.__init__(self, count, limit)
+        self.count = count
+        self.limit = limit
+
+
+class RPCError(jsonrpc.common.RPCError):
+    """
+    Error response from XBMC.
+    """
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+    def __unicode__(self):
+        return unicode(self.message)
+
+    def __reduce__(self):
+        return (RPCError, (self.code, self.message))
+
+
+def post_json(timeout, url, data):
+    """
+    Send data to XBMC as JSON and return the decoded response.
+    The timeout applies to the connection, a request that times out
+    is aborted. Takes the timeout first, like the functions called
+    by Link.call.
+    """
+    response = urllib2.urlopen(urllib2.Request(url, json.dumps(data),
+        {'Content-Type': 'application/json'}), timeout=timeout)
+    return json.load(response)
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to XBMC for a while after several failures
+    in a row. After the pause a single request is let through to test
+    whether XBMC recovered.
+    """
+
+    def __init__(self, failures=3, pause=10):
+        self._max_failures = failures
+        self._pause = pause
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0
+        self._testing = False
+
+    def before(self):
+        """
+        Raise CircuitOpen if the request should not be sent.
+        """
+        with self._lock:
+            if self._failures < self._max_failures:
+                return
+            if self._testing or time.time() < self._open_until:
+                raise CircuitOpen(u'XBMC is not responding')
+            self._testing = True
+
+    def succeeded(self):
+        with self._lock:
+            if self._failures >= self._max_failures:
+                logging.info(u'XBMC is responding again')
+            self._failures = 0
+            self._testing = False
+
+    def failed(self):
+        with self._lock:
+            self._failures += 1
+            self._testing = False
+            if self._failures >= self._max_failures:
+                if self._failures == self._max_failures:
+                    logging.warning(u'XBMC is not responding')
+                self._open_until = time.time() + self._pause
+
+
+class Link(object):
+    """
+    Sends requests to XBMC through the scheduler, with a deadline for
+    every method and a circuit breaker.
+    """
+
+    # Seconds to wait for a response, by method.
+    TIMEOUTS = {
+        'AudioLibrary.GetSongs': 120,
+        'Files.GetDirectory': 30,
+        'AudioPlaylist.GetItems': 15,
+        'batch': 30,
+        'download': 30}
+    DEFAULT_TIMEOUT = 5
+
+    RETRIES = 2
+    # Delay before the first retry, doubled for each next one (seconds).
+    RETRY_DELAY = 0.5
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.breaker = CircuitBreaker()
+
+    def call(self, method, func, *args, **kwargs):
+        """
+        Call func(timeout, *args, **kwargs) sending the method to XBMC,
+        func must use the timeout (in seconds) for its connection.
+        Raises XBMCUnavailable if it times out, can't connect or the
+        circuit breaker is open.
+        """
+        self.breaker.before()
+        timeout = self.TIMEOUTS.get(method, self.DEFAULT_TIMEOUT)
+
+        try:
+            result = self.scheduler.run(func, timeout, *args, **kwargs)
+        except (IOError, httplib.HTTPException) as e:
+            self.breaker.failed()
+            raise XBMCUnavailable(unicode(e))
+        except Exception:
+            # XBMC responded with an error.
+            self.breaker.succeeded()
+            raise
+
+        self.breaker.succeeded()
+        return result
+
+    def retry(self, func, *args, **kwargs):
+        """
+        Call func, retrying with a growing delay while XBMC is unavailable.
+        Only for requests that can be safely repeated.
+        Interactive requests are not retried, the client gets the error
+        instead of waiting.
+        """
+        if self.scheduler.priority() == Scheduler.INTERACTIVE:
+            return func(*args, **kwargs)
+
+        for attempt in itertools.count():
+            try:
+                return func(*args, **kwargs)
+            except CircuitOpen:
+                raise
+            except XBMCUnavailable as e:
+                if attempt >= self.RETRIES:
+                    raise
+                logging.info(u'retrying XBMC request: {}'.format(e))
+                time.sleep(self.RETRY_DELAY * 2 ** attempt)
+
+
+class RPCProxy(object):
+    """
+    Calls XBMC's JSON-RPC methods by attribute access
+    (proxy.AudioPlayer.GetTime()), every call goes through the link.
+    Calls are recorded if a recorder.Recorder is given.
+    """
+
+    def __init__(self, url, link, method='', recorder=None):
+        self._url = url
+        self._link = link
+        self._method = method
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if self._method:
+            method = self._method + '.' + name
+        else:
+            method = name
+        return RPCProxy(self._url, self._link, method, self._recorder)
+
+    def __call__(self, *args, **kwargs):
+        params = list(args) if args else kwargs
+
+        if self._recorder is None:
+            return self._link.call(self._method, self._send, params)
+
+        start = time.time()
+        try:
+            result = self._link.call(self._method, self._send, params)
+        except RPCError as e:
+            self._recorder.rpc(self._method, params, time.time() - start,
+                error={'code': e.code, 'message': e.message})
+            raise
+
+        self._recorder.rpc(self._method, params, time.time() - start, result)
+        return result
+
+    def _send(self, timeout, params):
+        response = post_json(timeout, self._url, {'jsonrpc': '2.0',
+            'method': self._method, 'params': params, 'id': 1})
+
+        error = response.get('error')
+        if error is not None:
+            raise RPCError(error.get('code'), error.get('message', u''))
+
+        return response.get('result')
+
+
+# Immutable value of a TimedVar together with its version.
+Snapshot = collections.namedtuple('Snapshot', ['version', 'value'])
+
+
+# Values of XBMCControl's variables used during processing of a single command.
+View = collections.namedtuple('View',
+    ['state', 'playlist', 'playlist_version', 'all_songs', 'volume', 'stale'])
+
+
+class TimedVar(object):
     """
     Recalculating a value at least every n seconds.
+
+    Every new value is published as a new Snapshot by replacing a single
+    reference, readers never wait for a recalculation.
+    Values must not be modified after they are set.
     """
     
+    FAILURE_RETRY = 5
+
     def __init__(self, func, timeout, update_thread):
         self._func = func
         self._timeout = timeout
         self._lock = threading.Lock()
+        self._flight = SingleFlight()
 
         self.changed = observer.Observable()
 
         self._last_update = time.time()
-        self._value = func()
+        self._snapshot = Snapshot(1, func())
+
+        # Set when the last recalculation failed and the value may be old.
+        self.stale = False
 
         update_thread.add_var(self)
     
     @property
     def value(self):
-        return self._value
+        return self._snapshot.value
 
     @value.setter
-    def value(self):
+    def value(self, value):
         with self._lock:
             self._set_value(value)
 
+    @property
+    def snapshot(self):
+        return self._snapshot
+
     def _set_value(self, value):
         """
         Imediately set the value and restart timeout.
         """
         self._last_update = time.time()
+        self.stale = False
 
-        if self._value == value:
+        if self._snapshot.value == value:
             return
 
+        self._snapshot = Snapshot(self._snapshot.version + 1, value)
         self.changed()
-        self._value = value
 
     def _time_remaining(self):
         remaining = self._last_update + self._timeout - time.time()
@@ -72,15 +428,37 @@ class TimedVar:
         else:
             return 0
 
-    def update(self):
+    def update(self, force=False):
         """
-        Imediately recalculate the value, set it and restart timeout.
+        Recalculate the value if the timeout expired (or always if force is set),
+        set it and restart timeout.
+        If the value is already being recalculated, wait for that instead.
         """
+        if not force and self._time_remaining() > 0:
+            return
+
+        self._flight.call(None, self._recalculate)
+
+    def _recalculate(self):
+        value = self._func()
         with self._lock:
-            if self._time_remaining() > 0:
-                return
+            self._set_value(value)
 
-            self._set_value(self._func())
+    def expire(self):
+        """
+        Let the update thread recalculate the value as soon as possible.
+        Failures of the recalculation are then handled by the update thread.
+        """
+        self._last_update = time.time() - self._timeout
+
+    def failed(self):
+        """
+        Mark the value as stale after a failed recalculation, try again
+        after at most FAILURE_RETRY seconds.
+        """
+        self.stale = True
+        self._last_update = time.time() - self._timeout + \
+            min(self._timeout, self.FAILURE_RETRY)
 
     def __lt__(self, other):
         return self._time_remaining() < other._time_remaining()
@@ -90,10 +468,11 @@ class UpdateThread(threading.Thread):
     """
     Thread that periodically updates TimedVars.
     """
-    def __init__(self):
+    def __init__(self, scheduler):
         super(UpdateThread, self).__init__(name="update thread")
         self.daemon = True
         self._list = []
+        self._scheduler = scheduler
 
     def add_var(self, variable):
         self._list.append(variable)
@@ -106,7 +485,42 @@ class UpdateThread(threading.Thread):
             next_var = self._list[0]
 
             time.sleep(next_var._time_remaining())
-            next_var.update()
+            try:
+                with self._scheduler.background():
+                    next_var.update()
+            except Exception:
+                logging.warning(u'update failed, keeping the old value',
+                    exc_info=True)
+                next_var.failed()
+
+
+class WarmUpThread(threading.Thread):
+    """
+    Thread that fills caches and indexes in the background after start
+    and after every library change.
+    """
+    def __init__(self, xbmc):
+        super(WarmUpThread, self).__init__(name="warm up thread")
+        self.daemon = True
+        self._xbmc = xbmc
+        self._requested = threading.Event()
+
+    def request(self):
+        """
+        Start warming up again.
+        """
+        self._requested.set()
+
+    def run(self):
+        while True:
+            self._requested.wait()
+            self._requested.clear()
+
+            try:
+                with self._xbmc.scheduler.background():
+                    self._xbmc.warm_up(self._requested)
+            except Exception:
+                logging.warning(u'cache warm up failed', exc_info=True)
 
 
 class XBMCControl(object):
@@ -124,38 +538,253 @@ class XBMCControl(object):
         'year',
         'duration']
 
+    # Fields kept in memory for every song when tags are loaded lazily.
+    RESIDENT_FIELDS = [
+        'file',
+        'title',
+        'artist',
+        'album',
+        'genre',
+        'duration']
+
+    # Maximal number of songs loaded by a single request in lazy mode.
+    HYDRATE_CHUNK = 200
+    # Songs closer than this in the library are loaded by a single request.
+    HYDRATE_GAP = 16
+    # Maximal number of songs loaded from XBMC to evaluate a single command
+    # (filter, sort or list by tags that are not in memory).
+    HYDRATE_LIMIT = 2000
+
+    # Levels of the music directory loaded by the warm up.
+    WARM_UP_DEPTH = 2
+    # Pause between warm up steps (seconds), leaves XBMC to the clients.
+    WARM_UP_DELAY = 0.2
+    # Tags whose sort orders are built by the warm up.
+    WARM_UP_SORT_TAGS = ['artist', 'album', 'title']
+
+    # Maximal number of requests running in XBMC at the same time.
+    CONNECTIONS = 2
+
     SUPPORTED_VERSION = 3
 
     STATE_TIMEOUT = 1
     PLAYLIST_TIMEOUT = 5
+    LIBRARY_PROBE_TIMEOUT = 30
+    # The probe doesn't see edited tags, they are found by the periodic
+    # full reload.
     LIBRARY_TIMEOUT = 3600
     VOLUME_TIMEOUT = 2
+    DIRECTORY_TIMEOUT = 300
+
+    ART_CACHE_SIZE = 16 * 1024 * 1024
+
+    # Error of a playlist operation with position out of the playlist.
+    BAD_POSITION = {'code': -32602, 'message': u'Bad song index'}
+
+    def __init__(self, url, musicpath, path_sep='/', columnar=False,
+        tag_cache_size=None, library_file=None, art_cache=None, recorder=None):
+        """
+        If tag_cache_size is set, only RESIDENT_FIELDS of the library are kept
+        in memory and the remaining tags are loaded when needed and cached
+        in at most tag_cache_size bytes.
+        If library_file is set, the library is saved to this file with
+        pre-encoded songs and loaded from it on start if XBMC's library
+        didn't change.
+        art_cache is the art.ArtCache for album art, by default only
+        ART_CACHE_SIZE bytes in memory.
+        If recorder (recorder.Recorder) is set, all XBMC requests are recorded.
+        """
+        self.scheduler = Scheduler(self.CONNECTIONS)
+        self.link = Link(self.scheduler)
+        self.recorder = recorder
+        self.call = RPCProxy(url, self.link, '', recorder)
+        self._url = url
 
-    def __init__(self, url, path_sep='/'):
-        self.call = jsonrpc.proxy.JSONRPCProxy.from_url(url)
+        self._flights = SingleFlight()
 
         self._check_version()
         self.path_sep = path_sep
+        self.musicpath = musicpath.rstrip(path_sep)
+        self.columnar = columnar
+        self.library_file = library_file
+        self._directory_paths = {}
+        self._path_types = {}
+        # XBMC paths outside of musicpath that were already reported.
+        self._outside_paths = set()
+
+        # Directory listings as XBMC path -> (time, result).
+        self._directories = {}
+
+        if art_cache is None:
+            art_cache = art.ArtCache(self.ART_CACHE_SIZE)
+        self.art_cache = art_cache
+        # XBMC path of a song -> its thumbnail or None.
+        self._thumbnails = {}
+
+        if tag_cache_size is None:
+            self._tag_cache = None
+            self.resident_tags = set(library.Song.TAGS)
+        else:
+            self._tag_cache = library.SongCache(tag_cache_size)
+            self.resident_tags = set(self.RESIDENT_FIELDS) - {'file'}
+
+        self.updater = UpdateThread(self.scheduler)
+        self.warm_up_thread = WarmUpThread(self)
 
-        self.updater = UpdateThread()
+        self._playlist_lock = threading.Lock()
+        # Version of the playlist last requested again by view().
+        self._expired_playlist_version = None
 
         self.state = \
             TimedVar(self._get_state, self.STATE_TIMEOUT, self.updater)
-        self.playlist = \
-            TimedVar(self._get_current_playlist, self.PLAYLIST_TIMEOUT, self.updater)
+        # The probe is taken before the library is loaded, so that changes
+        # made while loading are seen by the next probe.
+        self.library_probe = \
+            TimedVar(self._probe_library, self.LIBRARY_PROBE_TIMEOUT, self.updater)
         self.all_songs = \
             TimedVar(self._get_all_songs, self.LIBRARY_TIMEOUT, self.updater)
+        self.library_probe.changed.subscribe(self._library_probe_changed)
+        self.all_songs.changed.subscribe(self._library_changed)
+        self.playlist = \
+            TimedVar(self._get_current_playlist, self.PLAYLIST_TIMEOUT, self.updater)
         self.volume = \
             TimedVar(self._get_volume, self.VOLUME_TIMEOUT, self.updater)
 
+    def start(self, warm_up=True):
+        """
+        Start updating the cached variables and, if warm_up is set, warming
+        up the caches in the background. Processes that don't serve clients
+        don't need the caches.
+        """
         self.updater.start()
+        if warm_up:
+            self.start_warm_up()
+
+    def start_warm_up(self):
+        self.warm_up_thread.start()
+        self.warm_up_thread.request()
         
+    def view(self):
+        """
+        Return a View with the current values of the cached variables.
+
+        The state is requested more often than the playlist, its current
+        song may not be in the playlist yet (when the playlist was changed
+        in XBMC). The view then has no current song and the playlist is
+        requested again.
+        """
+        playlist = self.playlist.snapshot
+        state = self.state.value
+
+        if state is not None and \
+            not 0 <= state['current'] < len(playlist.value):
+            state = dict(state, current=None)
+            if self._expired_playlist_version != playlist.version:
+                self._expired_playlist_version = playlist.version
+                self.playlist.expire()
+
+        stale = self.state.stale or self.playlist.stale or \
+            self.all_songs.stale or self.volume.stale
+        return View(state, playlist.value, playlist.version,
+            self.all_songs.value, self.volume.value, stale)
+
     def _check_version(self):
         jsonrpc_version = self.call.JSONRPC.Version()['version']
         if jsonrpc_version != self.SUPPORTED_VERSION:
             raise RuntimeError(
                 'Unsupported protocol version {}.'.format(jsonrpc_version))
 
+    def _query(self, method, **params):
+        """
+        Call a read only XBMC method.
+        Identical queries running at the same time share a single request.
+        """
+        key = (method, json.dumps(params, sort_keys=True))
+        func = reduce(getattr, method.split('.'), self.call)
+        return self._flights.call(key, self.link.retry, func, **params)
+
+    def batch(self, calls):
+        """
+        Send a list of (method, params) pairs as a single JSON-RPC batch.
+
+        Returns list of (result, error) pairs in the same order, error is None
+        or a dictionary with 'code' and 'message'.
+        """
+        if not calls:
+            return []
+
+        request = [
+            {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': i}
+            for i, (method, params) in enumerate(calls)]
+
+        start = time.time()
+        responses = {item['id']: item for item in
+            self.link.call('batch', post_json, self._url, request)}
+        duration = time.time() - start
+
+        results = [(responses[i].get('result'), responses[i].get('error'))
+            for i in range(len(calls))]
+
+        if self.recorder is not None:
+            for (method, params), (result, error) in \
+                itertools.izip(calls, results):
+                self.recorder.rpc(method, params, duration, result, error)
+
+        return results
+
+    def xbmc_path_to_mpd_path(self, path):
+        """
+        Converts a path that xbmc uses (based at filesystem root)
+        to path format for mpd (relative to music path).
+        Paths outside of the music path (other sources, smb:// URLs) are
+        kept unchanged, like MPD keeps URLs of songs outside its music
+        directory.
+        """
+        if path != self.musicpath and \
+            not path.startswith(self.musicpath + self.path_sep):
+            if path not in self._outside_paths:
+                self._outside_paths.add(path)
+                logging.warning(
+                    u'{} is outside of the music path, using it as is'.format(
+                        path))
+            return path
+
+        path = path[len(self.musicpath):]
+        path = path.strip(self.path_sep)
+        path = path.replace(self.path_sep, '/')
+
+        return path
+
+    def mpd_path_to_xbmc_path(self, path):
+        """
+        Converts a path suitable for MPD to path for XBMC
+        Almost inverse for xbmc_path_to_mpd_path()
+        Paths of known songs and directories are taken from the snapshots.
+        """
+        song = self.all_songs.value.by_path.get(path)
+        if song is not None:
+            return song.file
+
+        directory = self._directory_paths.get(path)
+        if directory is not None:
+            return directory
+
+        if path in self._outside_paths:
+            return path
+
+        path = path.replace('/', self.path_sep)
+        path = self.musicpath + self.path_sep + path
+        return path
+
+    def _make_songs(self, songs):
+        """
+        Convert a list of song dictionaries from XBMC to song records.
+        """
+        intern = library.Interner()
+        return [library.Song.from_xbmc(song,
+                self.xbmc_path_to_mpd_path(song['file']), intern)
+            for song in songs]
+
     def get_time(self):
         """
         Return a tuple with elapsed time and duration of the current song
@@ -184,43 +813,168 @@ class XBMCControl(object):
 
     def get_directory(self, path):
         """
-        Get list of files, list of directories and list of playlists.
+        Get list of songs, list of directories and list of playlists.
+        Directories and playlists are returned as library.Entry.
+        Listings are cached until the library changes or DIRECTORY_TIMEOUT
+        expires. An expired listing is still used while XBMC is unavailable.
         """
+        cached = self._directories.get(path)
+        if cached is not None and \
+            cached[0] + self.DIRECTORY_TIMEOUT > time.time():
+            return cached[1]
+
+        try:
+            result = self._get_directory(path)
+        except XBMCUnavailable:
+            if cached is None:
+                raise
+            logging.info(u'XBMC unavailable, using old listing of ' + path)
+            return cached[1]
+
+        self._directories[path] = (time.time(), result)
+        return result
+
+    def _get_directory(self, path):
         #TODO: Attempting to list a nonexistent directory causes an exception. Detect it.
 
         filelist = []
         dirlist = []
         pllist = []
 
-        for f in self.call.Files.GetDirectory(
+        for f in self._query('Files.GetDirectory',
             directory=path, fields=self.SONG_FIELDS, media='music')['files']:
             if f['filetype'] == 'directory':
+                entry = library.Entry(
+                    f['file'], self.xbmc_path_to_mpd_path(f['file']))
                 if f['file'].endswith(self.path_sep):
-                    dirlist.append(f)
+                    dirlist.append(entry)
+                    self._directory_paths[entry.path] = entry.file
+                    self._path_types[entry.file] = 'directory'
                 else:
-                    pllist.append(f)
+                    pllist.append(entry)
             else:
                 filelist.append(f)
+                self._path_types[f['file']] = 'file'
+
+        return (tuple(self._make_songs(filelist)), tuple(dirlist),
+            tuple(pllist))
 
-        return (filelist, dirlist, pllist)
+    def get_album_art(self, path):
+        """
+        Return bytes of the album art of the song at XBMC path,
+        or an empty string if it has none.
+        Images are downloaded once and then served from the art cache.
+        """
+        thumbnail = self._thumbnail(path)
+        if not thumbnail:
+            return ''
 
+        return self._flights.call(('art', thumbnail), self.art_cache.get,
+            thumbnail, lambda: self._download(thumbnail))
+
+    def _thumbnail(self, path):
+        """
+        Return the thumbnail of a song, taken from listing of its directory.
+        """
+        if path in self._thumbnails:
+            return self._thumbnails[path]
+
+        directory = path[:path.rfind(self.path_sep) + 1]
+        thumbnails = {}
+        for f in self._query('Files.GetDirectory', directory=directory,
+            fields=['file', 'thumbnail'], media='music')['files']:
+            if f['filetype'] != 'directory':
+                thumbnails[f['file']] = f.get('thumbnail') or None
+
+        self._thumbnails.update(thumbnails)
+        return thumbnails.get(path)
+
+    def _download(self, thumbnail):
+        """
+        Fetch a thumbnail from XBMC's web server, return None if it is missing.
+        """
+        try:
+            result = self._query('Files.Download', path=thumbnail)
+        except jsonrpc.common.RPCError:
+            result = None
+
+        if isinstance(result, dict):
+            result = result.get('path')
+        if not result:
+            result = 'vfs/' + urllib.quote(thumbnail.encode('utf8'), safe='')
+
+        url = urlparse.urljoin(self._url, result)
+
+        def fetch(timeout):
+            try:
+                return urllib2.urlopen(url, timeout=timeout).read()
+            except urllib2.HTTPError as e:
+                if e.code == 404:
+                    return None
+                raise
 
-    def list_playlists(self):
-        return [] #TODO: Implement this when jsonrpc api supports listing playlists.
+        return self.link.call('download', fetch)
 
     def _get_current_playlist(self):
         """
         Get the music playlist contents.
 
+        Only file names are requested and the songs are taken from the library.
+        Tags are requested from XBMC only if some of the files are unknown.
+
         Returns a list filled by each file's tags
         """
-        x = self.call.AudioPlaylist.GetItems(fields=self.SONG_FIELDS)
+        x = self._query('AudioPlaylist.GetItems', fields=['file'])
         if 'state' in x:
             self.state.value = x['state']
         else:
             self.state.value = None
 
-        return x.get('items', [])
+        songs = [self._library_song(item['file']) for item in x.get('items', [])]
+
+        if None in songs:
+            x = self._query('AudioPlaylist.GetItems', fields=self.SONG_FIELDS)
+            return library.Playlist(self._make_songs(x.get('items', [])))
+
+        return library.Playlist(self.hydrate(songs))
+
+    def _library_song(self, path):
+        """
+        Return song from the library specified by its XBMC path, or None.
+        """
+        if not path.startswith(self.musicpath):
+            return None
+
+        return self.all_songs.value.by_path.get(self.xbmc_path_to_mpd_path(path))
+
+    def _edit_playlist(self, func):
+        """
+        Apply func to a copy of the cached playlist and store the result
+        as the new playlist.
+        """
+        with self._playlist_lock:
+            playlist = list(self.playlist.value)
+            func(playlist)
+            self.playlist.value = library.Playlist(playlist)
+
+    def _playlist_added(self, path, position=None):
+        """
+        Update the cached playlist after a path was added to XBMC's playlist.
+        If the path is not a known song, the playlist is requested again.
+        """
+        song = self._library_song(path)
+
+        if song is None:
+            self.playlist.update(force=True)
+            return
+
+        song = next(iter(self.hydrate([song])))
+
+        if position is None:
+            self._edit_playlist(lambda playlist: playlist.append(song))
+        else:
+            self._edit_playlist(
+                lambda playlist: playlist.insert(position, song))
 
     def next(self):
         """
@@ -254,7 +1008,268 @@ class XBMCControl(object):
         """
         List of all songs
         """
-        return self.call.AudioLibrary.GetSongs(fields=self.SONG_FIELDS)['songs']
+        if self._tag_cache is None:
+            fields = self.SONG_FIELDS
+        else:
+            fields = self.RESIDENT_FIELDS
+
+        # Taken before the songs are requested, a change that comes
+        # while loading then only causes one more reload.
+        probe = self.library_probe.value
+
+        previous = getattr(self, 'all_songs', None)
+        if previous is not None:
+            previous = previous.value
+        elif self.library_file is not None:
+            previous, stored_probe = self._load_library_file()
+            if previous is not None and stored_probe == probe:
+                return previous
+
+        data = self._query('AudioLibrary.GetSongs', fields=fields)['songs']
+
+        if previous is not None:
+            songs = self._update_library(previous, data)
+            if songs is not previous:
+                self._save_library_file(songs, probe)
+            return songs
+
+        songs = self._make_songs(data)
+
+        if songs:
+            logging.info(u'library loaded: {} songs, {} bytes per song'.format(
+                len(songs), library.memory_usage(songs) // len(songs)))
+
+        songs = library.Library(songs, self.columnar, self.resident_tags)
+        self._save_library_file(songs, probe)
+        return songs
+
+    def _load_library_file(self):
+        """
+        Load library snapshot from the library file.
+        Returns tuple of the library (or None if the file can't be used)
+        and the library probe value stored in the file.
+        """
+        mapped = libraryfile.load(self.library_file)
+        if mapped is None or not mapped.tags.issuperset(self.resident_tags):
+            return None, None
+
+        songs = library.Library(mapped.songs(), self.columnar,
+            self.resident_tags)
+        songs.blocks = mapped
+        logging.info(u'library loaded from {}: {} songs'.format(
+            self.library_file, len(songs)))
+
+        return songs, mapped.probe
+
+    def _save_library_file(self, songs, probe):
+        """
+        Write the library snapshot to the library file and use the
+        pre-encoded songs from it. probe is the library probe value taken
+        before the songs were requested.
+        """
+        if self.library_file is None:
+            return
+
+        try:
+            libraryfile.save(self.library_file, songs.songs, probe,
+                self.resident_tags)
+            songs.blocks = libraryfile.LibraryFile(self.library_file)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning(u'saving library file {} failed: {}'.format(
+                self.library_file, e))
+
+    def _update_library(self, previous, data):
+        """
+        Compare songs from XBMC with the previous library snapshot and
+        create a new snapshot by applying only the differences.
+        Returns the previous snapshot if nothing changed.
+        """
+        intern = library.Interner()
+        songs = []
+        # Ranges of unchanged songs as [new position, old position, count].
+        runs = []
+        added = []
+        removed = []
+        seen = set()
+
+        for item in data:
+            position = previous.file_position(item['file'])
+
+            if position is not None:
+                seen.add(position)
+                old = previous.songs[position]
+                if old.matches(item):
+                    if runs and runs[-1][0] + runs[-1][2] == len(songs) and \
+                        runs[-1][1] + runs[-1][2] == position:
+                        runs[-1][2] += 1
+                    else:
+                        runs.append([len(songs), position, 1])
+                    songs.append(old)
+                    continue
+                removed.append(old)
+                if self._tag_cache is not None:
+                    self._tag_cache.discard(old.file)
+
+            song = library.Song.from_xbmc(item,
+                self.xbmc_path_to_mpd_path(item['file']), intern)
+            songs.append(song)
+            added.append(song)
+
+        if len(seen) < len(previous.songs):
+            removed.extend(song for i, song in enumerate(previous.songs)
+                if i not in seen)
+
+        # Without changes all songs are in a single range.
+        if not added and not removed and len(runs) <= 1:
+            return previous
+
+        logging.info(u'library updated: {} new or modified, {} removed or modified'
+            .format(len(added), len(removed)))
+
+        return previous.updated(songs, runs, added, removed)
+
+    def _probe_library(self):
+        """
+        Cheaply check the library for changes.
+        Returns a tuple with number of songs and id of the last song,
+        which changes when songs are added or removed.
+        """
+        total = self.call.AudioLibrary.GetSongs(
+            limits={'start': 0, 'end': 1})['limits']['total']
+
+        if total == 0:
+            return (0, None)
+
+        last = self.call.AudioLibrary.GetSongs(
+            limits={'start': total - 1, 'end': total})['songs']
+
+        return (total, last[0]['songid'] if last else None)
+
+    def _library_changed(self):
+        self._directories = {}
+        self._thumbnails = {}
+        self.warm_up_thread.request()
+
+    def warm_up(self, restart):
+        """
+        Build the library indexes and load top levels of the music directory
+        to the directory cache, pausing between the steps.
+        Stops early when the restart event is set.
+        """
+        songs = self.all_songs.value
+        songs.file_position(None) # builds the position index
+
+        for tag in self.WARM_UP_SORT_TAGS:
+            if restart.is_set():
+                return
+            if tag in self.resident_tags:
+                songs.order(tag)
+                time.sleep(self.WARM_UP_DELAY)
+
+        queue = collections.deque([(self.mpd_path_to_xbmc_path(u''), 1)])
+        while queue and not restart.is_set():
+            path, depth = queue.popleft()
+            filelist, dirlist, pllist = self.get_directory(path)
+
+            if depth < self.WARM_UP_DEPTH:
+                queue.extend((d.file, depth + 1) for d in dirlist)
+
+            time.sleep(self.WARM_UP_DELAY)
+
+        logging.debug(u'cache warm up finished')
+
+    def _library_probe_changed(self):
+        logging.info(u'library changed, reloading')
+        self.all_songs.expire()
+
+    def hydrate(self, songs):
+        """
+        Return iterable of the given songs with all tags loaded.
+        Only does some work if the tags are loaded lazily.
+        """
+        if self._tag_cache is None:
+            return songs
+
+        return self._hydrate_chunks(iter(songs))
+
+    def hydrate_all(self, songs):
+        """
+        Return list of the given songs with all tags loaded, for commands
+        that need the tags of all of them and not only of the songs sent.
+        Raises TooManySongs if more than HYDRATE_LIMIT songs would have to be
+        loaded from XBMC.
+        """
+        songs = list(songs)
+        if self._tag_cache is None:
+            return songs
+
+        missing = sum(1 for song in songs
+            if not song.is_complete() and song.file not in self._tag_cache)
+        if missing > self.HYDRATE_LIMIT:
+            raise TooManySongs(missing, self.HYDRATE_LIMIT)
+
+        return list(self.hydrate(songs))
+
+    def _hydrate_chunks(self, songs):
+        while True:
+            chunk = list(itertools.islice(songs, self.HYDRATE_CHUNK))
+            if not chunk:
+                return
+
+            for song in self._hydrate(chunk):
+                yield song
+
+    def _hydrate(self, songs):
+        """
+        Load missing tags of songs from the tag cache or from XBMC.
+        Songs are requested in runs of neighbouring library positions,
+        a single AudioLibrary.GetSongs call for each run.
+        """
+        result = []
+        missing = []
+        for song in songs:
+            if not song.is_complete():
+                song = self._tag_cache.get(song.file) or song
+            if not song.is_complete():
+                missing.append(len(result))
+            result.append(song)
+
+        if not missing:
+            return result
+
+        all_songs = self.all_songs.value
+        positions = sorted(set(
+            all_songs.position(result[i]) for i in missing) - {None})
+
+        loaded = {}
+        for start, end in self._position_runs(positions):
+            data = self._query('AudioLibrary.GetSongs', fields=self.SONG_FIELDS,
+                limits={'start': start, 'end': end}).get('songs', [])
+            for song in self._make_songs(data):
+                loaded[song.file] = song
+                self._tag_cache.put(song)
+
+        for i in missing:
+            result[i] = loaded.get(result[i].file, result[i])
+
+        return result
+
+    def _position_runs(self, positions):
+        """
+        Group sorted library positions to (start, end) ranges.
+        """
+        start = None
+        for position in positions:
+            if start is None:
+                start = end = position
+            elif position - end > self.HYDRATE_GAP:
+                yield (start, end + 1)
+                start = end = position
+            else:
+                end = position
+
+        if start is not None:
+            yield (start, end + 1)
 
     def seekto(self, time):
         """
@@ -280,7 +1295,9 @@ class XBMCControl(object):
 
             self.call.AudioPlaylist.Play()
         else:
-            self.state.value.update(result)
+            state = dict(self.state.value or {})
+            state.update(result)
+            self.state.value = state
 
     def play(self):
         self.state.update()
@@ -302,48 +1319,253 @@ class XBMCControl(object):
         the playlist.
         """
         self.call.AudioPlaylist.Remove(pos)
-        self.playlist.update()
+
+        out_of_sync = []
+
+        def remove(playlist):
+            if 0 <= pos < len(playlist):
+                del playlist[pos]
+            else:
+                out_of_sync.append(pos)
+
+        self._edit_playlist(remove)
+
+        if out_of_sync:
+            self.playlist.update(force=True)
     
-    def add_to_playlist(self, path):
+    def _path_type(self, path):
         """
-        Add the given path to the playlist.
+        Return 'file' or 'directory' if type of the XBMC path is known,
+        otherwise None.
         """
+        if self._library_song(path) is not None:
+            return 'file'
+
+        return self._path_types.get(path)
+
+    def _add_path(self, path, add):
+        """
+        Call add with a playlist item for the given path.
+        Returns type of the path ('file' or 'directory').
+        """
+        path_type = self._path_type(path)
+        if path_type is not None:
+            add({path_type: path})
+            return path_type
+
         # This is a little hack ...
         # XBMC wants to know if the item added is a file or a directory
         # so we try to add the item as a file and if this fails try adding
-        # it as a directory
+        # it as a directory. The result is remembered for next time.
         try:
-            self.call.AudioPlaylist.Add({'file': path})
+            add({'file': path})
+            path_type = 'file'
         except jsonrpc.common.RPCError as e:
             if e.code != -32602:
                 raise
 
-            self.call.AudioPlaylist.Add({'directory': path})
-        finally:
-            self.playlist.update()
+            add({'directory': path})
+            path_type = 'directory'
+
+        self._path_types[path] = path_type
+        return path_type
+
+    def add_to_playlist(self, path):
+        """
+        Add the given path to the playlist.
+        """
+        if self._add_path(path, self.call.AudioPlaylist.Add) == 'file':
+            self._playlist_added(path)
+        else:
+            self.playlist.update(force=True)
 
     def insert_into_playlist(self, path, position):
         """
         Add given path to the playlist at a position.
         """
-        #The same hack as for add_to_playlist
-        try:
-            self.call.AudioPlaylist.Insert(position, {'file': path})
-            return
-        except jsonrpc.common.RPCError as e:
-            if e.code != -32602:
-                raise
+        def insert(item):
+            self.call.AudioPlaylist.Insert(position, item)
 
-            self.call.AudioPlaylist.Insert(position, {'directory': path})
-        finally:
-            self.playlist.update()
+        if self._add_path(path, insert) == 'file':
+            self._playlist_added(path, position)
+        else:
+            self.playlist.update(force=True)
+
+    def edit_playlist(self, operations):
+        """
+        Apply a list of playlist operations, sending as many of them as
+        possible in a single batch request.
+
+        Operations are tuples ('add', path), ('insert', path, position)
+        and ('remove', position). Paths whose type (file or directory)
+        is not known yet are added separately, using add_to_playlist or
+        insert_into_playlist.
+
+        Returns list of (position, error) pairs, position is the
+        playlist position of an added song (if known) and error is None or
+        a dictionary with 'code' and 'message'.
+
+        Processing stops at the first error, which is then the last item
+        of the returned list. Positions are checked against the cached
+        playlist before anything is sent, an invalid one gets the error
+        BAD_POSITION and nothing after it is done. If XBMC fails an
+        operation inside a batch, the following operations of the batch
+        were still done by XBMC; the error is reported for the failed
+        operation and the playlist is requested again.
+        """
+        results = []
+        pending = []
+        # Length of the playlist after the pending operations.
+        length = len(self.playlist.value)
+
+        for operation in operations:
+            if not self._valid_position(operation, length):
+                results.extend(self._edit_playlist_batch(pending))
+                if not self._failed(results):
+                    results.append((None, self.BAD_POSITION))
+                return results
+
+            if operation[0] == 'remove':
+                pending.append(operation)
+                length -= 1
+                continue
+
+            path_type = self._path_type(operation[1])
+            if path_type == 'file':
+                pending.append(operation)
+                length += 1
+                continue
+
+            # Directory or unknown type, length of the playlist after it
+            # is known only from the updated cached playlist.
+            if path_type == 'directory':
+                pending.append(operation)
+                results.extend(self._edit_playlist_batch(pending))
+                pending = []
+            else:
+                results.extend(self._edit_playlist_batch(pending))
+                pending = []
+                if self._failed(results):
+                    return results
+
+                try:
+                    if operation[0] == 'add':
+                        self.add_to_playlist(operation[1])
+                    else:
+                        self.insert_into_playlist(operation[1], operation[2])
+                except jsonrpc.common.RPCError as e:
+                    results.append(
+                        (None, {'code': e.code, 'message': unicode(e)}))
+                else:
+                    results.append((None, None))
+
+            if self._failed(results):
+                return results
+
+            length = len(self.playlist.value)
+
+        results.extend(self._edit_playlist_batch(pending))
+        return results
+
+    @staticmethod
+    def _failed(results):
+        return bool(results) and results[-1][1] is not None
+
+    @staticmethod
+    def _valid_position(operation, length):
+        if operation[0] == 'remove':
+            return 0 <= operation[1] < length
+        elif operation[0] == 'insert':
+            return 0 <= operation[2] <= length
+        else:
+            return True
+
+    def _edit_playlist_batch(self, operations):
+        """
+        Send playlist operations on paths of known type as a single batch
+        and apply them to the cached playlist.
+        If some of the added paths is not a song from the library, the
+        playlist is requested again instead.
+        """
+        calls = []
+        songs = []
+        for operation in operations:
+            if operation[0] == 'remove':
+                calls.append(('AudioPlaylist.Remove', [operation[1]]))
+                songs.append(None)
+                continue
+
+            item = {self._path_type(operation[1]): operation[1]}
+            if operation[0] == 'add':
+                calls.append(('AudioPlaylist.Add', [item]))
+            else:
+                calls.append(('AudioPlaylist.Insert', [operation[2], item]))
+            songs.append(self._library_song(operation[1]))
+
+        responses = self.batch(calls)
+
+        complete = iter(list(self.hydrate(s for s in songs if s is not None)))
+        songs = [None if s is None else next(complete) for s in songs]
+
+        positions = []
+        out_of_sync = []
+
+        def apply(playlist):
+            for operation, song, (result, error) in \
+                itertools.izip(operations, songs, responses):
+                if error is not None:
+                    # XBMC goes on with the batch after an error, the
+                    # operations after it are taken from the playlist.
+                    positions.append(None)
+                    out_of_sync.append(operation)
+                    break
+                elif operation[0] != 'remove' and song is None:
+                    if operation[0] == 'insert':
+                        positions.append(operation[2])
+                    else:
+                        positions.append(None)
+                    out_of_sync.append(operation)
+                elif out_of_sync:
+                    if operation[0] == 'insert':
+                        positions.append(operation[2])
+                    else:
+                        positions.append(None)
+                elif operation[0] == 'add':
+                    positions.append(len(playlist))
+                    playlist.append(song)
+                elif operation[0] == 'insert':
+                    positions.append(operation[2])
+                    playlist.insert(operation[2], song)
+                else:
+                    positions.append(None)
+                    if operation[1] < len(playlist):
+                        del playlist[operation[1]]
+                    else:
+                        out_of_sync.append(operation)
+
+        if operations:
+            self._edit_playlist(apply)
+
+        # Results up to the first error.
+        results = [(position, error)
+            for position, (result, error) in zip(positions, responses)]
+
+        if len(results) < len(operations):
+            logging.warning(u'playlist operation failed inside a batch, '
+                u'{} following operations were still done: {}'.format(
+                len(operations) - len(results), results[-1][1].get('message')))
+
+        if out_of_sync:
+            self.playlist.update(force=True)
+
+        return results
 
     def clear(self):
         """
         Clear the current playlist
         """
         self.call.AudioPlaylist.Clear()
-        self.playlist.update()
+        self.playlist.value = library.Playlist()
 
     def _get_state(self):
         """
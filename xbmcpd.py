@@ -16,14 +16,20 @@
 # You should have received a copy of the GNU General Public License
 # along with xbmcpd.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import logging
-import twisted.internet.reactor
-import twisted.internet.protocol
-import twisted.protocols.basic
+import os
+import stat
+import socket
 import argparse
 
-import mpd
 import xbmc
+import workers
+import art
+import recorder
+
+# Twisted and the mpd module (which imports the reactor) are imported in
+# serve(), so that each forked worker creates its own reactor.
 
 arg_parser = argparse.ArgumentParser(
     description="Controlling XBMC from MPD clients.",
@@ -32,28 +38,161 @@ arg_parser = argparse.ArgumentParser(
 arg_parser.add_argument('--url', default='http://localhost/jsonrpc',
     help="URL of the JSONRPC interface (default: %(default)s)")
 arg_parser.add_argument('--port', '-p', default=6600, type=int,
-    help="port for the MPD server (default: %(default)s)")
+    help="port for the MPD server, 0 disables TCP (default: %(default)s)")
+arg_parser.add_argument('--socket', metavar='PATH',
+    help="also serve MPD clients on a unix domain socket at PATH")
 arg_parser.add_argument('--musicpath', required=True,
     help="root of the music database on the XBMC machine")
 arg_parser.add_argument('--pathsep', default='/',
     help="path separator on the xbmc machine (default: '%(default)s')")
+arg_parser.add_argument('--threads', default=4, type=int,
+    help="number of threads executing client commands, 0 executes them "
+        "in the main thread (default: %(default)s)")
+arg_parser.add_argument('--columnar', action='store_true',
+    help="keep a columnar copy of the library for faster find, count and list")
+arg_parser.add_argument('--lazy-tags', type=float, metavar='MB',
+    help="keep only the basic tags of the library in memory and cache "
+        "at most MB megabytes of the complete songs")
+arg_parser.add_argument('--library-file', metavar='PATH',
+    help="save the library with pre-encoded songs to a memory mapped file "
+        "and load it from there on start when XBMC's library didn't change")
+arg_parser.add_argument('--playlist-dir', metavar='PATH',
+    help="directory for the stored playlists, they are disabled if not set")
+arg_parser.add_argument('--art-cache', default=16, type=float, metavar='MB',
+    help="keep at most MB megabytes of album art in memory "
+        "(default: %(default)s)")
+arg_parser.add_argument('--art-cache-dir', metavar='PATH',
+    help="also keep downloaded album art in a directory")
+arg_parser.add_argument('--art-cache-dir-size', default=256, type=float,
+    metavar='MB',
+    help="size limit of the album art directory (default: %(default)s)")
+arg_parser.add_argument('--record', metavar='PATH',
+    help="append client commands and XBMC requests to PATH, "
+        "for replaying with replay.py")
+arg_parser.add_argument('--workers', default=0, type=int, metavar='N',
+    help="serve clients from N forked processes sharing the port, "
+        "0 serves them from the main process (default: %(default)s)")
 arg_parser.add_argument('--verbose',
     action='store_const', const=logging.DEBUG, default=logging.INFO,
     help="enable debugging outputs")
 arguments = arg_parser.parse_args()
 
+if not arguments.port and not arguments.socket:
+    arg_parser.error("either --port or --socket is needed")
+
 logging.basicConfig(level=arguments.verbose, format=u'%(asctime)s %(message)s',
     datefmt=u'%x %X')
 logging.info("XBMCpd starting")
 
-xbmc = xbmc.XBMCControl(arguments.url, arguments.pathsep)
-mpd.MPD.xbmc = xbmc
-mpd.MPD.musicpath = arguments.musicpath.rstrip(xbmc.path_sep)
+if arguments.lazy_tags is None:
+    tag_cache_size = None
+else:
+    tag_cache_size = int(arguments.lazy_tags * 1024 * 1024)
+
+if arguments.record:
+    command_recorder = recorder.Recorder(arguments.record,
+        arguments.musicpath, arguments.pathsep)
+else:
+    command_recorder = None
+
+art_cache = art.ArtCache(int(arguments.art_cache * 1024 * 1024),
+    arguments.art_cache_dir, int(arguments.art_cache_dir_size * 1024 * 1024))
+
+def unix_socket(path):
+    """
+    Return a listening unix domain socket, replacing a stale socket file.
+    Exits if a running server listens on the socket file.
+    """
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error as e:
+            if e.errno != errno.ECONNREFUSED:
+                raise
+            os.remove(path)
+        else:
+            arg_parser.error("{} is used by a running server".format(path))
+        finally:
+            probe.close()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(50)
+    sock.setblocking(False)
+    return sock
+
+def serve(xbmc_control, sock=None):
+    """
+    Run the MPD server, on the listening TCP socket if given.
+    """
+    import twisted.internet.reactor
+    import twisted.internet.protocol
+    import twisted.protocols.basic
+    import twisted.python.threadpool
+
+    import mpd
+    import playlists
+
+    mpd.MPD.xbmc = xbmc_control
+    mpd.MPD.recorder = command_recorder
+
+    if arguments.playlist_dir:
+        mpd.MPD.playlists = playlists.PlaylistStore(arguments.playlist_dir)
+
+    if arguments.threads > 0:
+        thread_pool = twisted.python.threadpool.ThreadPool(
+            1, arguments.threads, 'mpd commands')
+        twisted.internet.reactor.callWhenRunning(thread_pool.start)
+        twisted.internet.reactor.addSystemEventTrigger(
+            'during', 'shutdown', thread_pool.stop)
+        mpd.MPD.thread_pool = thread_pool
+
+    factory = twisted.internet.protocol.ServerFactory()
+    factory.protocol = mpd.MPD
+
+    if sock is not None:
+        twisted.internet.reactor.adoptStreamPort(
+            sock.fileno(), socket.AF_INET, factory)
+        sock.close()
+    elif arguments.port:
+        twisted.internet.reactor.listenTCP(arguments.port, factory)
+
+    if arguments.port:
+        logging.info('starting MPD server at port {}'.format(arguments.port))
+
+    if local_socket is not None:
+        twisted.internet.reactor.adoptStreamPort(
+            local_socket.fileno(), socket.AF_UNIX, factory)
+        local_socket.close()
+        logging.info('starting MPD server at {}'.format(arguments.socket))
+
+    twisted.internet.reactor.run()
+
+def serve_worker(worker):
+    if arguments.port:
+        serve(worker.xbmc, workers.listen_socket(arguments.port))
+    else:
+        serve(worker.xbmc)
 
-factory = twisted.internet.protocol.ServerFactory()
-factory.protocol = mpd.MPD
-twisted.internet.reactor.listenTCP(arguments.port, factory)
+xbmc = xbmc.XBMCControl(arguments.url, arguments.musicpath, arguments.pathsep,
+    arguments.columnar, tag_cache_size, arguments.library_file, art_cache,
+    command_recorder)
 
-logging.info('starting MPD server at port {}'.format(arguments.port))
+# The unix socket is created before forking, workers accept connections
+# from the same socket.
+if arguments.socket:
+    local_socket = unix_socket(arguments.socket)
+else:
+    local_socket = None
 
-twisted.internet.reactor.run()
+if arguments.workers > 0:
+    coordinator = workers.Coordinator(xbmc)
+    for i in range(arguments.workers):
+        coordinator.fork_worker(serve_worker)
+    if local_socket is not None:
+        local_socket.close()
+    coordinator.run()
+else:
+    xbmc.start()
+    serve(xbmc)